@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""Benchmark cocrypto.DataStorage across algorithms, modes and sizes.
+
+Each combination of payload size, hash algorithm, block algorithm, mode
+and file format is saved and loaded once (or --repeat times) in a fresh
+worker process, so the peak resident memory of one case does not leak
+into the next. Seekable saves always use counter mode, so they are run
+under CTR alone. Results are written as one JSON object per line, giving
+throughput, peak memory and how the time divides between padding,
+cipher setup, encryption, base64 and hashing.
+
+Combinations that cocrypto or the crypto library refuse, such as stream
+ciphers with a block mode, are reported with an error instead of timings.
+
+The full default matrix is large and goes up to 1 GB, so narrow it down
+with the options when you only need part of it.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import shutil
+import tempfile
+import resource
+from multiprocessing import Pool
+from timeit import default_timer as clock
+
+import cocrypto
+
+# Kept before _instrument() swaps in _TimedStorage.
+_DataStorage = cocrypto.DataStorage
+
+SIZES = '1K,16K,256K,4M,64M,1G'
+HASHES = 'md5,sha1,sha224,sha256,sha384,sha512'
+ALGORITHMS = 'AES,ARC2,ARC4,Blowfish,CAST,DES,DES3,IDEA,RC5,XOR'
+MODES = 'CBC,CFB,CTR,ECB,OFB,PGP'
+FORMATS = 'text,binary,seekable'
+
+# The phases of save and load that are timed separately. Encryption 
+# covers decryption as well, as counter mode decrypts by encrypting.
+# Setup is making the cipher objects, which sets up the key.
+PHASES = ('padding', 'setup', 'encryption', 'base64', 'hashing')
+
+# Running totals of each phase, for the case being run in this process.
+_TIMES = dict.fromkeys(PHASES, 0.0)
+
+def parse_size(size):
+    """Turn a size such as 512, 16K, 4M or 1G into a number of bytes.
+
+    >>> [parse_size(size) for size in ('512', '16K', ' 4m', '1G')]
+    [512, 16384, 4194304, 1073741824]
+
+    """
+    multipliers = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    size = size.strip().upper()
+    if size[-1] in multipliers:
+        return int(size[:-1]) * multipliers[size[-1]]
+    return int(size)
+
+def _timed(phase, function):
+    """Wrap the function so its run time is added to the phase."""
+    def timed_function(*args, **kwargs):
+        """Call the wrapped function and count the time."""
+        start = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _TIMES[phase] += clock() - start
+    return timed_function
+
+class _TimedHash(object):
+    """A hash object whose update and digest are timed as hashing."""
+
+    def __init__(self, secure_hash):
+        self._hash = secure_hash
+        self.update = _timed('hashing', secure_hash.update)
+        self.digest = _timed('hashing', secure_hash.digest)
+
+    def __getattr__(self, name):
+        return getattr(self._hash, name)
+
+class _TimedHashlib(object):
+    """Stands in for hashlib in cocrypto, handing out timed hashes."""
+
+    def __getattr__(self, name):
+        constructor = _timed('hashing', getattr(hashlib, name))
+        def timed_constructor(*args):
+            """Make a timed hash object."""
+            return _TimedHash(constructor(*args))
+        return timed_constructor
+
+class _TimedAlgorithm(object):
+    """Stands in for a block algorithm module, timing its ciphers."""
+
+    def __init__(self, algorithm):
+        self._algorithm = algorithm
+
+    def new(self, *args, **kwargs):
+        """Make a cipher whose encrypt and decrypt are timed,
+        timing the making of it as setup."""
+        cipher = _timed('setup', self._algorithm.new)(*args, **kwargs)
+        return _TimedCipher(cipher)
+
+    def __getattr__(self, name):
+        return getattr(self._algorithm, name)
+
+class _TimedCipher(object):
+    """A cipher object with timed encrypt and decrypt methods."""
+
+    def __init__(self, cipher):
+        self.encrypt = _timed('encryption', cipher.encrypt)
+        self.decrypt = _timed('encryption', cipher.decrypt)
+
+class _TimedStorage(_DataStorage):
+    """A DataStorage that times its ciphers and its padding.
+
+    Padding has no method of its own, so it is the time spent in
+    _encrypt() that is not spent making the cipher, encrypting or
+    base64 encoding.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        _DataStorage.__init__(self, *args, **kwargs)
+        self.block_algorithm = _TimedAlgorithm(self.block_algorithm)
+
+    def _encrypt(self, *args, **kwargs):
+        before = _TIMES['setup'] + _TIMES['encryption'] + _TIMES['base64']
+        start = clock()
+        _DataStorage._encrypt(self, *args, **kwargs)
+        inside = (_TIMES['setup'] + _TIMES['encryption'] +
+                  _TIMES['base64'] - before)
+        _TIMES['padding'] += clock() - start - inside
+
+def _instrument():
+    """Swap timed versions into cocrypto, in the worker process only."""
+    cocrypto.hashlib = _TimedHashlib()
+    cocrypto.b64encode = _timed('base64', cocrypto.b64encode)
+    cocrypto.b64decode = _timed('base64', cocrypto.b64decode)
+    # Worker segments of a seekable save make their own DataStorage.
+    cocrypto.DataStorage = _TimedStorage
+
+def _phase_times(total):
+    """Return a copy of the phase times, with the rest of total as other."""
+    times = dict(_TIMES)
+    times['other'] = max(total - sum(times.values()), 0.0)
+    for phase in _TIMES:
+        _TIMES[phase] = 0.0
+    return times
+
+def run_case(case):
+    """Save and load one combination, returning a dictionary of results.
+
+    This runs in a worker process of its own.
+
+    """
+    size, hash_algorithm, algorithm, mode, file_format, repeat = case
+    result = {'size': size,
+              'hash': hash_algorithm,
+              'algorithm': algorithm,
+              'mode': mode,
+              'format': file_format,
+              'repeat': repeat}
+    directory = tempfile.mkdtemp('-cocryptobench')
+    filename = os.path.join(directory, 'bench.ddf')
+    key_filename = os.path.join(directory, 'bench.key')
+    try:
+        _instrument()
+        text = os.urandom(size)
+        storage = cocrypto.DataStorage(hash_algorithm, algorithm, mode)
+        save_time = load_time = 0.0
+        for i in xrange(repeat):
+            start = clock()
+            storage.save(text, filename, key_filename,
+                         binary = file_format == 'binary',
+                         seekable = file_format == 'seekable')
+            save_time += clock() - start
+        save_phases = _phase_times(save_time)
+        for i in xrange(repeat):
+            start = clock()
+            new_storage = cocrypto.DataStorage(hash_algorithm, algorithm, mode)
+            new_storage.load(filename, key_filename)
+            load_time += clock() - start
+        load_phases = _phase_times(load_time)
+        if new_storage.text != text:
+            raise ValueError("The loaded text does not match.")
+    except (Exception, SystemExit), error:
+        result['error'] = '%s: %s' % (error.__class__.__name__, error)
+        return result
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+    megabytes = size * repeat / float(2 ** 20)
+    result.update({
+        'save_seconds': save_time,
+        'load_seconds': load_time,
+        'save_mb_per_second': megabytes / save_time,
+        'load_mb_per_second': megabytes / load_time,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'save_phases': save_phases,
+        'load_phases': load_phases})
+    return result
+
+def cases(sizes, hashes, algorithms, modes, formats, repeat):
+    """Generate every combination of the given lists.
+
+    Seekable saves always use counter mode, so they are run once under
+    CTR rather than once for each mode.
+
+    >>> for case in cases([1024], ['md5'], ['AES'], ['CBC', 'OFB'],
+    ...                   ['text', 'seekable'], 1):
+    ...     print case
+    (1024, 'md5', 'AES', 'CBC', 'text', 1)
+    (1024, 'md5', 'AES', 'OFB', 'text', 1)
+    (1024, 'md5', 'AES', 'CTR', 'seekable', 1)
+
+    """
+    for size in sizes:
+        for hash_algorithm in hashes:
+            for algorithm in algorithms:
+                for file_format in formats:
+                    if file_format == 'seekable':
+                        format_modes = ['CTR']
+                    else:
+                        format_modes = modes
+                    for mode in format_modes:
+                        yield (size, hash_algorithm, algorithm, mode,
+                               file_format, repeat)
+
+def main():
+    """Run the benchmarks and write the results as JSON lines."""
+    from optparse import OptionParser
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage = usage)
+    parser.add_option("-s", "--sizes",
+                      action="store", dest="sizes",
+                      default=SIZES,
+                      help="comma separated payload sizes, e.g. 1K,4M,1G")
+    parser.add_option("--hashes",
+                      action="store", dest="hashes",
+                      default=HASHES,
+                      help="comma separated hash algorithms")
+    parser.add_option("-a", "--algorithms",
+                      action="store", dest="algorithms",
+                      default=ALGORITHMS,
+                      help="comma separated block algorithms")
+    parser.add_option("-m", "--modes",
+                      action="store", dest="modes",
+                      default=MODES,
+                      help="comma separated modes")
+    parser.add_option("-f", "--formats",
+                      action="store", dest="formats",
+                      default=FORMATS,
+                      help="comma separated formats: text, binary, seekable")
+    parser.add_option("-r", "--repeat",
+                      action="store", type="int", dest="repeat",
+                      default=1,
+                      help="save and load each case N times")
+    parser.add_option("-o", "--output",
+                      action="store", dest="output",
+                      default=None,
+                      help="write the results to a file instead of stdout")
+    (options, args) = parser.parse_args()
+
+    if options.output:
+        output = open(options.output, 'w')
+    else:
+        output = sys.stdout
+    matrix = cases([parse_size(size) for size in options.sizes.split(',')],
+                   options.hashes.split(','),
+                   options.algorithms.split(','),
+                   options.modes.split(','),
+                   options.formats.split(','),
+                   options.repeat)
+    # A new process for each case, so peak memory is measured separately.
+    pool = Pool(1, maxtasksperchild = 1)
+    for result in pool.imap(run_case, matrix):
+        output.write(json.dumps(result, sort_keys = True) + '\n')
+        output.flush()
+    pool.close()
+    pool.join()
+
+# start the ball rolling
+if __name__ == "__main__":
+    main()
@@ -2,59 +2,1050 @@
 """Recursively order a directory of files by last modified date."""
 
 import os
+import re
+import sys
+import operator
+import stat
+import time
+import errno
+import heapq
+import bisect
+import ctypes
+import ctypes.util
+import struct
+import itertools
+import sqlite3
 import datetime
+import threading
+import Queue
+from array import array
+from json.encoder import encode_basestring_ascii
 
-class ModifyHist(dict):
-    """A sorted dictionary-like object of modifications."""
+# Use scandir where we can, from Python 3.5 or the scandir package.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
-    def __init__(self, path = None, quiet = None):
-        """Initialises the file history. 
+# numpy makes sorting a large history quicker and smaller, if it is there.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Directories are scanned by this many threads,
+# which helps most on high latency network filesystems.
+THREADS = 8
+
+# Directories modified this close to the start of a refresh are rescanned
+# next time, as they may change again within the filesystem's mtime
+# resolution without their mtime moving.
+RACY_SECONDS = 2
+
+# What can be written out about each file, and how.
+FIELDS = ('path', 'mtime', 'size', 'inode')
+FORMATS = ('text', 'nul', 'json', 'csv')
+
+# Output is gathered into writes of about this many bytes.
+BUFFER_SIZE = 2 ** 20
+
+class ModifyHist(object):
+    """A sorted history of modifications.
+
+    Every file is kept, however many share an mtime. The details are
+    held in columns rather than an object per file: each directory name
+    is stored once, the file names are packed into one buffer and the
+    mtimes, sizes and inodes are in arrays. The order is a permutation
+    of positions in those arrays, newest first.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> for name, raw_mtime in [('a', 100), ('b', 200), ('c', 100)]:
+    ...     filename = os.path.join(directory, name)
+    ...     open(filename, 'w').close()
+    ...     os.utime(filename, (raw_mtime, raw_mtime))
+    >>> history = ModifyHist(directory)
+    >>> len(history), history.keys()
+    (3, [200.0, 100.0, 100.0])
+    >>> [os.path.basename(filename) for filename in history][0]
+    'b'
+    >>> sorted(os.path.basename(filename) for filename in history)
+    ['a', 'b', 'c']
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, path = None, quiet = None, threads = THREADS,
+                 index = None):
+        """Initialises the file history.
+        If no path is specfied then start from current working directory.
+        The mtimes are the raw modification times in seconds since the
+        epoch, use datetime.datetime.fromtimestamp() to show them.
+        If an MtimeIndex is given, it is refreshed and read instead of
+        walking the whole tree."""
+        if path:
+            self.path = path
+        else:
+            self.path = os.getcwd()
+        self.directories = []
+        self.directory_ids = array('I')
+        self.names = bytearray()
+        self.name_ends = array('L')
+        self.mtimes = array('d')
+        self.sizes = array('d')
+        self.inodes = array('L')
+
+        if index:
+            walk = index.walk_tree
+        else:
+            walk = walk_tree
+        interned = {}
+        for filename, raw_mtime, size, inode in walk(self.path, quiet,
+                                                     threads):
+            directory, name = os.path.split(filename)
+            directory_id = interned.get(directory)
+            if directory_id is None:
+                directory_id = interned[directory] = len(self.directories)
+                self.directories.append(directory)
+            self.directory_ids.append(directory_id)
+            self.names.extend(name)
+            self.name_ends.append(len(self.names))
+            self.mtimes.append(raw_mtime)
+            self.sizes.append(size)
+            self.inodes.append(inode)
+        self.order = _sort_order(self.mtimes)
+
+    def __len__(self):
+        return len(self.mtimes)
+
+    def __iter__(self):
+        """Iterates over the filenames, newest first."""
+        for position in self.order:
+            yield self.filename(position)
+
+    def keys(self):
+        """Returns a list of the mtimes, newest first."""
+        return [self.mtimes[position] for position in self.order]
+
+    def filename(self, position):
+        """Returns the filename stored at a position in the columns."""
+        if position:
+            start = self.name_ends[position - 1]
+        else:
+            start = 0
+        return os.path.join(self.directories[self.directory_ids[position]],
+                            str(self.names[start:self.name_ends[position]]))
+
+    def entries(self):
+        """Yields (filename, mtime, size, inode) for every file,
+        newest first."""
+        for position in self.order:
+            yield (self.filename(position), self.mtimes[position],
+                   int(self.sizes[position]), self.inodes[position])
+
+def _sort_order(mtimes):
+    """Returns an array of the positions in mtimes, newest first."""
+    order = array('L')
+    if numpy is not None and mtimes:
+        # A stable sort of the negated mtimes keeps ties in walk order.
+        negated = -numpy.frombuffer(mtimes, numpy.float64)
+        positions = numpy.argsort(negated, kind = 'mergesort')
+        order.fromstring(positions.astype(numpy.dtype('L')).tostring())
+    else:
+        order.extend(sorted(xrange(len(mtimes)), key = mtimes.__getitem__,
+                            reverse = True))
+    return order
+
+def recent_files(path = None, count = None, since = None, quiet = None,
+                 threads = THREADS, index = None):
+    """Returns a list of (filename, mtime, size, inode) tuples,
+    newest first.
+
+    Only the count most recent files are kept while walking, in a
+    bounded heap, so memory does not grow with the size of the tree.
+    Files modified before since, in seconds since the epoch,
+    are dropped straight away. Files with the same mtime are put in
+    reverse order of filename, so the same ones are kept at the cutoff
+    whatever order the walk finds them in.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> os.makedirs(os.path.join(directory, 'sub', 'deeper'))
+    >>> for name, raw_mtime in [('a', 100), ('e', 200), ('sub/b', 300),
+    ...                         ('sub/c', 200), ('sub/deeper/d', 200)]:
+    ...     filename = os.path.join(directory, name)
+    ...     open(filename, 'w').close()
+    ...     os.utime(filename, (raw_mtime, raw_mtime))
+    >>> def names(entries):
+    ...     return [(os.path.relpath(entry[0], directory), entry[1])
+    ...             for entry in entries]
+    >>> names(recent_files(directory))
+    ... # doctest: +NORMALIZE_WHITESPACE
+    [('sub/b', 300.0), ('sub/deeper/d', 200.0), ('sub/c', 200.0),
+     ('e', 200.0), ('a', 100.0)]
+    >>> for threads in (1, 4):
+    ...     print names(recent_files(directory, 3, threads = threads))
+    [('sub/b', 300.0), ('sub/deeper/d', 200.0), ('sub/c', 200.0)]
+    [('sub/b', 300.0), ('sub/deeper/d', 200.0), ('sub/c', 200.0)]
+    >>> names(recent_files(directory, 10, since = 200))
+    [('sub/b', 300.0), ('sub/deeper/d', 200.0), ('sub/c', 200.0), ('e', 200.0)]
+    >>> shutil.rmtree(directory)
+    """
+    if not path:
+        path = os.getcwd()
+    if index:
+        walk = index.walk_tree
+    else:
+        walk = walk_tree
+    heap = []
+    for filename, raw_mtime, size, inode in walk(path, quiet, threads):
+        if since is not None and raw_mtime < since:
+            continue
+        if count is None or len(heap) < count:
+            heapq.heappush(heap, (raw_mtime, filename, size, inode))
+        elif raw_mtime > heap[0][0] or (raw_mtime == heap[0][0] and
+                                        filename > heap[0][1]):
+            # Newer than the oldest one we are keeping.
+            heapq.heapreplace(heap, (raw_mtime, filename, size, inode))
+    heap.sort(reverse=True)
+    return [(filename, raw_mtime, size, inode)
+            for raw_mtime, filename, size, inode in heap]
+
+def parse_since(text):
+    """Turns a cutoff into seconds since the epoch. The cutoff is either
+    an age such as 90s, 30m, 12h, 7d or 2w, or a date and time such as
+    2009-06-30 or '2009-06-30 12:30'.
+
+    >>> parse_since('2009-06-30') == time.mktime(
+    ...     (2009, 6, 30, 0, 0, 0, 0, 0, -1))
+    True
+    >>> parse_since('2009-06-30 12:30') - parse_since('2009-06-30')
+    45000.0
+    >>> abs(time.time() - parse_since('2h') - 7200) < 60
+    True
+    >>> parse_since('yesterday')
+    Traceback (most recent call last):
+    ...
+    ValueError: Cannot understand the time 'yesterday'.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    age = re.match(r'^(\d+(?:\.\d+)?)([smhdw])$', text.strip())
+    if age:
+        return time.time() - float(age.group(1)) * units[age.group(2)]
+    for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text.strip(), date_format))
+        except ValueError:
+            pass
+    raise ValueError("Cannot understand the time %r." % text)
+
+def walk_tree(path, quiet = None, threads = THREADS):
+    """Yields (filename, mtime, size, inode) for every file below path.
+
+    Like os.walk, symlinks to directories are not followed and
+    directories that cannot be listed are skipped. The directories are
+    shared out between a pool of threads and the files are yielded as
+    each directory is finished, so the order is not fixed.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> for number in range(20):
+    ...     subdirectory = os.path.join(directory, str(number % 4),
+    ...                                 str(number))
+    ...     os.makedirs(subdirectory)
+    ...     open(os.path.join(subdirectory, 'file'), 'w').close()
+    ...     open(os.path.join(directory, str(number % 4), str(number) +
+    ...                       '.txt'), 'w').close()
+    >>> os.symlink(directory, os.path.join(directory, 'loop'))
+    >>> serial = sorted(walk_tree(directory, threads = 1))
+    >>> len(serial)
+    40
+    >>> sorted(walk_tree(directory, threads = 6)) == serial
+    True
+    >>> shutil.rmtree(directory)
+    """
+    def scan(directory):
+        """Returns the files and the subdirectories of a directory."""
+        return _scan_directory(directory, quiet)
+    for files in _map_tree(path, scan, threads):
+        for details in files:
+            yield details
+
+def _map_tree(path, scan, threads = THREADS):
+    """Calls scan on path and on every directory it names, in a pool of
+    threads, and yields what they return as they finish.
+
+    The scan function returns a result and a list of subdirectories,
+    which are scanned in turn."""
+    if threads < 2:
+        directories = [path]
+        while directories:
+            result, subdirectories = scan(directories.pop())
+            directories.extend(subdirectories)
+            yield result
+        return
+
+    directories = Queue.Queue()
+    results = Queue.Queue()
+    stop = threading.Event()
+
+    def worker():
+        """Scan directories from the queue until told to stop."""
+        while True:
+            directory = directories.get()
+            if directory is None or stop.is_set():
+                return
+            try:
+                results.put((True, scan(directory)))
+            except Exception, error:
+                results.put((False, error))
+
+    workers = []
+    for i in range(threads):
+        thread = threading.Thread(target = worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+
+    # This thread keeps count of the directories still to be scanned.
+    directories.put(path)
+    outstanding = 1
+    try:
+        while outstanding:
+            succeeded, result = results.get()
+            outstanding -= 1
+            if not succeeded:
+                raise result
+            result, subdirectories = result
+            for subdirectory in subdirectories:
+                directories.put(subdirectory)
+            outstanding += len(subdirectories)
+            yield result
+    finally:
+        stop.set()
+        for i in range(threads):
+            directories.put(None)
+        # Let idle workers finish before the interpreter shuts down,
+        # without waiting on any stuck on a slow directory.
+        for thread in workers:
+            thread.join(1)
+
+class MtimeIndex(object):
+    """A record on disk, in SQLite, of the files below some directories.
+
+    Adding or removing a file changes the mtime of its directory, so a
+    refresh only lists the directories whose mtime has moved since the
+    last one and otherwise costs one stat per directory. A file that
+    is rewritten in place does not touch its directory, and is not
+    noticed until that directory next changes or the index is rebuilt.
+    Paths are kept absolute, but given back in the form they were
+    asked for, as walk_tree would give them.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> for name in ['caf\\xc3\\xa9/a', 'caf\\xc3\\xa9/sub/b',
+    ...              'caf\\xc3\\xa9x/c', '\\xc3\\xa9/x/y/d', 'latin\\xe9']:
+    ...     filename = os.path.join(directory, name)
+    ...     if not os.path.isdir(os.path.dirname(filename)):
+    ...         os.makedirs(os.path.dirname(filename))
+    ...     open(filename, 'w').close()
+    >>> index = MtimeIndex(os.path.join(directory, 'index.db'))
+    >>> def names(path):
+    ...     return sorted(os.path.relpath(entry[0], directory)
+    ...                   for entry in index.walk_tree(path))
+    >>> names(directory) # doctest: +NORMALIZE_WHITESPACE
+    ['caf\\xc3\\xa9/a', 'caf\\xc3\\xa9/sub/b', 'caf\\xc3\\xa9x/c', 'index.db',
+     'latin\\xe9', '\\xc3\\xa9/x/y/d']
+    >>> names(os.path.join(directory, 'caf\\xc3\\xa9'))
+    ['caf\\xc3\\xa9/a', 'caf\\xc3\\xa9/sub/b']
+    >>> shutil.rmtree(os.path.join(directory, '\\xc3\\xa9'))
+    >>> os.remove(os.path.join(directory, 'caf\\xc3\\xa9', 'sub', 'b'))
+    >>> names(directory)
+    ['caf\\xc3\\xa9/a', 'caf\\xc3\\xa9x/c', 'index.db', 'latin\\xe9']
+    >>> index.connection.execute("SELECT count(*) FROM directories").fetchone()
+    (4,)
+    >>> index.close()
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, filename, rebuild = False):
+        """Opens the index, emptying it first if rebuild is true
+        or if it was made by an older version."""
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        # Filenames are bytes, which need not be valid UTF-8, so they
+        # are kept as blobs and compared byte by byte.
+        self.connection.text_factory = str
+        version = self.connection.execute("PRAGMA user_version").fetchone()
+        if rebuild or version[0] != _INDEX_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS directories")
+            self.connection.execute("DROP TABLE IF EXISTS files")
+            self.connection.execute("PRAGMA user_version = %d"
+                                    % _INDEX_VERSION)
+        # A null mtime means scan the directory next time.
+        self.connection.execute("CREATE TABLE IF NOT EXISTS directories "
+                                "(path BLOB PRIMARY KEY, parent BLOB, "
+                                "mtime REAL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files "
+                                "(path BLOB PRIMARY KEY, directory BLOB, "
+                                "mtime REAL, size INTEGER, inode INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS files_directory "
+                                "ON files (directory)")
+        self.connection.commit()
+
+    def walk_tree(self, path, quiet = None, threads = THREADS):
+        """Refreshes the index below path, then returns an iterator of
+        (filename, mtime, size, inode) for every file below it,
+        like the walk_tree function."""
+        self.refresh(path, quiet, threads)
+        return self.files(path)
+
+    def files(self, path):
+        """Returns an iterator of (filename, mtime, size, inode) for
+        every file recorded below path, starting with path as given."""
+        absolute = os.path.abspath(path)
+        rows = self.connection.execute(
+            "SELECT path, mtime, size, inode FROM files "
+            "WHERE directory = ? OR (directory >= ? AND directory < ?)",
+            _below(absolute))
+        if path == absolute:
+            return ((str(filename), raw_mtime, size, inode)
+                    for filename, raw_mtime, size, inode in rows)
+        # Put back the path that was given in place of the absolute one.
+        given = path.rstrip(os.sep) or os.sep
+        start = len(absolute.rstrip(os.sep))
+        return ((given + filename[start:], raw_mtime, size, inode)
+                for filename, raw_mtime, size, inode in rows)
+
+    def refresh(self, path, quiet = None, threads = THREADS):
+        """Brings the index up to date below path, scanning only the
+        directories that are new or have changed."""
+        path = os.path.abspath(path)
+        started = time.time()
+        known = {}
+        children = {}
+        for directory, parent, mtime in self.connection.execute(
+            "SELECT path, parent, mtime FROM directories"):
+            directory = str(directory)
+            known[directory] = mtime
+            children.setdefault(str(parent), []).append(directory)
+
+        def scan(directory):
+            """Returns the directory, its mtime and either its files and
+            subdirectories or None if it has not changed,
+            along with the subdirectories to look at next."""
+            try:
+                # Before listing, so changes while listing are seen next time.
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                return (directory, None, None), []
+            if known.get(directory) == mtime:
+                return (directory, mtime, None), children.get(directory, [])
+            scanned = _scan_directory(directory, quiet)
+            return (directory, mtime, scanned), scanned[1]
+
+        for directory, mtime, scanned in _map_tree(path, scan, threads):
+            if mtime is None:
+                # It has gone since its parent was listed.
+                self._forget(directory)
+                continue
+            if scanned is None:
+                continue
+            files, subdirectories = scanned
+            subdirectories = set(subdirectories)
+            for subdirectory in children.get(directory, ()):
+                if subdirectory not in subdirectories:
+                    self._forget(subdirectory)
+            self.connection.execute("DELETE FROM files WHERE directory = ?",
+                                    (buffer(directory),))
+            self.connection.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                ((buffer(filename), buffer(directory), raw_mtime, size, inode)
+                 for filename, raw_mtime, size, inode in files))
+            if mtime >= started - RACY_SECONDS:
+                mtime = None
+            self.connection.execute(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)",
+                (buffer(directory), buffer(os.path.dirname(directory)),
+                 mtime))
+        self.connection.commit()
+
+    def _forget(self, directory):
+        """Removes a directory and everything below it from the index."""
+        for table, column in (('files', 'directory'), ('directories', 'path')):
+            self.connection.execute(
+                "DELETE FROM %s WHERE %s = ? OR (%s >= ? AND %s < ?)"
+                % (table, column, column, column), _below(directory))
+
+    def close(self):
+        """Closes the index file."""
+        self.connection.close()
+
+def _below(directory):
+    """Returns the directory, and the first and the last bounds of the
+    paths below it, as blobs for an index query. Every path below the
+    directory starts with it and a separator, so it falls in that range
+    of bytes, whatever the characters in it."""
+    prefix = directory.rstrip(os.sep)
+    return (buffer(directory), buffer(prefix + os.sep),
+            buffer(prefix + chr(ord(os.sep) + 1)))
+
+class Watcher(object):
+    """Keeps the files below a directory in order of modification and
+    follows their changes with Linux inotify, so nothing is rescanned.
+
+    Each directory is watched before it is listed, so files created
+    while the tree is first scanned are not missed. If the kernel's
+    event queue overflows the whole tree is scanned again."""
+
+    def __init__(self, path = None, quiet = None, threads = THREADS):
+        """Watches and scans the tree.
         If no path is specfied then start from current working directory."""
-        dict.__init__(self)
         if path:
             self.path = path
         else:
             self.path = os.getcwd()
+        self.quiet = quiet
+        self.threads = threads
+        # The mtime of each file and the files sorted by (mtime, filename).
+        self.mtimes = {}
+        self.order = []
+        # Watched directories by watch descriptor.
+        self.directories = {}
+        self.fd = _inotify().inotify_init()
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._add_tree(self.path)
+
+    def newest(self, count = None, since = None):
+        """Returns a list of (mtime, filename) tuples, newest first."""
+        start = 0
+        if since is not None:
+            start = bisect.bisect_left(self.order, (since,))
+        if count:
+            start = max(start, len(self.order) - count)
+        return self.order[:start - 1 if start else None:-1]
 
-        lstfiles = os.walk(self.path)
-        for i in lstfiles:
-            directory = i[0]
-            for j in i[2]:
-                filename = os.path.join(directory, j)
+    def changes(self):
+        """Yields (mtime, filename) for each file as it changes,
+        with an mtime of None for files that are removed."""
+        while True:
+            for change in self._handle(self._read_events()):
+                yield change
+
+    def close(self):
+        """Stops watching."""
+        os.close(self.fd)
+
+    def _add_tree(self, path):
+        """Watches and scans path and everything below it,
+        returning the files that are new or have changed."""
+        def scan(directory):
+            """Watches then lists a directory."""
+            watch = _add_watch(self.fd, directory, self.quiet)
+            files, subdirectories = _scan_directory(directory, self.quiet)
+            return (watch, directory, files), subdirectories
+        changed = []
+        replaced = []
+        for watch, directory, files in _map_tree(path, scan, self.threads):
+            if watch >= 0:
+                self.directories[watch] = directory
+            for filename, raw_mtime, size, inode in files:
+                old_mtime = self.mtimes.get(filename)
+                if old_mtime != raw_mtime:
+                    self.mtimes[filename] = raw_mtime
+                    changed.append((raw_mtime, filename))
+                    if old_mtime is not None:
+                        replaced.append((old_mtime, filename))
+        changed.sort()
+        if len(changed) <= _INSORT_LIMIT:
+            for raw_mtime, filename in replaced:
+                self._unorder(raw_mtime, filename)
+            for change in changed:
+                bisect.insort(self.order, change)
+        else:
+            # Inserting one at a time would take quadratic time.
+            if replaced:
+                replaced = set(replaced)
+                self.order = [pair for pair in self.order
+                              if pair not in replaced]
+            # Two sorted runs, which sort() merges in linear time.
+            self.order.extend(changed)
+            self.order.sort()
+        return changed
+
+    def _update(self, filename, raw_mtime):
+        """Records the mtime of a file, returning False if it is the same."""
+        old_mtime = self.mtimes.get(filename)
+        if old_mtime == raw_mtime:
+            return False
+        if old_mtime is not None:
+            self._unorder(old_mtime, filename)
+        self.mtimes[filename] = raw_mtime
+        # Changes are mostly the newest, so this is mostly an append.
+        bisect.insort(self.order, (raw_mtime, filename))
+        return True
+
+    def _unorder(self, raw_mtime, filename):
+        """Takes a file out of the ordering."""
+        del self.order[bisect.bisect_left(self.order, (raw_mtime, filename))]
+
+    def _forget(self, filename):
+        """Forgets a file, returning False if it was not known."""
+        raw_mtime = self.mtimes.pop(filename, None)
+        if raw_mtime is None:
+            return False
+        self._unorder(raw_mtime, filename)
+        return True
+
+    def _forget_tree(self, directory):
+        """Stops watching a directory that has gone or moved away, and
+        everything below it, returning the files known to be below it."""
+        prefix = directory.rstrip(os.sep) + os.sep
+        for watch, watched in self.directories.items():
+            if watched == directory or watched.startswith(prefix):
+                # Moved directories are still watched under the old name.
+                _inotify().inotify_rm_watch(self.fd, watch)
+                del self.directories[watch]
+        return [filename for filename in self.mtimes
+                if filename.startswith(prefix)]
+
+    def _read_events(self):
+        """Waits for events and returns a list of
+        (watch, mask, filename) tuples."""
+        while True:
+            try:
+                data = os.read(self.fd, 2 ** 16)
+                break
+            except OSError, error:
+                if error.errno != errno.EINTR:
+                    raise
+        events = []
+        position = 0
+        while position < len(data):
+            watch, mask, cookie, length = _EVENT.unpack_from(data, position)
+            position += _EVENT.size
+            name = data[position:position + length].rstrip('\0')
+            position += length
+            directory = self.directories.get(watch)
+            if mask & _IN_Q_OVERFLOW:
+                events.append((watch, mask, None))
+            elif directory is not None:
+                events.append((watch, mask, os.path.join(directory, name)
+                               if name else directory))
+        return events
+
+    def _handle(self, events):
+        """Brings the ordering up to date with a batch of events,
+        returning the changes sorted by mtime."""
+        touched = set()
+        removed = set()
+        new_directories = []
+        changes = []
+        for watch, mask, filename in events:
+            if mask & _IN_Q_OVERFLOW:
+                return self._rescan()
+            if mask & _IN_IGNORED:
+                self.directories.pop(watch, None)
+            elif mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    new_directories.append(filename)
+                elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                    removed.update(self._forget_tree(filename))
+            elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                touched.discard(filename)
+                removed.add(filename)
+            elif mask & _WATCH_MASK:
+                removed.discard(filename)
+                touched.add(filename)
+        # Each file is looked at once however many events it had.
+        for filename in touched:
+            try:
+                raw_mtime = os.stat(filename).st_mtime
+            except OSError:
                 try:
-                    raw_mtime = os.stat(filename).st_mtime
+                    # A broken symlink.
+                    raw_mtime = os.lstat(filename).st_mtime
                 except OSError:
-                    # File Errors
-                    if not os.access(filename, os.R_OK):
-                        # If we don't have permission to read the file.
-                        
-                        # Make a fake time.
-                        # 1 am on the first of January, 1970.
-                        # The start of the 32bit epoch.
-                        # I won't be born until over a decade later,
-                        # So I won't have files that old.
-                        raw_mtime = 0000000000.0
-                        if not quiet:
-                            print "We do not have permission to read", filename
-                        
-                    elif os.path.islink(filename):
-                        # If the file is a broken symlink.
-                        raw_mtime = os.lstat(filename).st_mtime
-                        if not quiet:
-                            print "Warning the following symlink", filename, \
-                            "appears to be broken."
-                    else:
-                        # Some other problem, lets just give up.
-                        raise
-                
-                mtime = datetime.datetime.fromtimestamp(raw_mtime)
-                self[mtime] = filename
+                    removed.add(filename)
+                    continue
+            if self._update(filename, raw_mtime):
+                changes.append((raw_mtime, filename))
+        for directory in new_directories:
+            changes.extend(self._add_tree(directory))
+        changes.sort()
+        return [(None, filename) for filename in sorted(removed)
+                if self._forget(filename)] + changes
 
-    def keys(self):
-        """"D.keys() -> list of D's mtimes."""
-        keys = dict.keys(self)
-        keys.sort(reverse=True)
-        return keys
+    def _rescan(self):
+        """Scans the whole tree again after events have been lost."""
+        old_mtimes = self.mtimes
+        self.mtimes = {}
+        self.order = []
+        self._add_tree(self.path)
+        changes = [(raw_mtime, filename)
+                   for raw_mtime, filename in self.order
+                   if old_mtimes.get(filename) != raw_mtime]
+        return [(None, filename) for filename in sorted(old_mtimes)
+                if filename not in self.mtimes] + changes
+
+# Watcher puts up to this many files into its ordering one at a time,
+# and more by sorting the lot.
+_INSORT_LIMIT = 64
+
+# Bumped when the layout of the MtimeIndex tables changes,
+# which rebuilds older index files.
+_INDEX_VERSION = 1
+
+# Linux inotify, from linux/inotify.h.
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_DONT_FOLLOW = 0x02000000
+_IN_EXCL_UNLINK = 0x04000000
+_IN_ISDIR = 0x40000000
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM |
+               _IN_MOVED_TO | _IN_CREATE | _IN_DELETE)
+# struct inotify_event, followed by the name padded with NULs.
+_EVENT = struct.Struct('iIII')
+_LIBC = []
+
+def _inotify():
+    """Returns the C library, raising OSError if it has no inotify."""
+    if not _LIBC:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno = True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        _LIBC.append(libc)
+    return _LIBC[0]
+
+def _add_watch(fd, directory, quiet = None):
+    """Watches a directory, returning the watch descriptor or -1."""
+    watch = _inotify().inotify_add_watch(fd, directory, _WATCH_MASK |
+                                         _IN_ONLYDIR | _IN_DONT_FOLLOW |
+                                         _IN_EXCL_UNLINK)
+    if watch < 0 and not quiet:
+        error = ctypes.get_errno()
+        print >> sys.stderr, "Cannot watch", directory, os.strerror(error)
+        if error == errno.ENOSPC:
+            print >> sys.stderr, \
+                "Raise fs.inotify.max_user_watches to watch more."
+    return watch
+
+def _scan_directory(directory, quiet = None):
+    """Returns the details of the files in a directory
+    and a list of its subdirectories."""
+    files = []
+    subdirectories = []
+    try:
+        if scandir:
+            entries = [(entry.path, entry.is_dir(), entry.is_symlink(),
+                        entry.stat)
+                       for entry in scandir(directory)]
+        else:
+            entries = []
+            for name in os.listdir(directory):
+                filename = os.path.join(directory, name)
+                entries.append(_lstat_entry(filename))
+    except OSError:
+        # Like os.walk, skip directories we cannot list.
+        return files, subdirectories
+
+    for filename, is_dir, is_symlink, get_stat in entries:
+        if is_dir:
+            if not is_symlink:
+                subdirectories.append(filename)
+            continue
+        status = _stat_file(filename, get_stat, quiet)
+        if status is None:
+            # Make a fake time.
+            # 1 am on the first of January, 1970.
+            # The start of the 32bit epoch.
+            # I won't be born until over a decade later,
+            # So I won't have files that old.
+            files.append((filename, 0000000000.0, 0, 0))
+        else:
+            files.append((filename, status.st_mtime, status.st_size,
+                          status.st_ino))
+    return files, subdirectories
+
+def _lstat_entry(filename):
+    """Without scandir, find out about a file with one lstat call,
+    except for symlinks which need another to follow them."""
+    try:
+        status = os.lstat(filename)
+    except OSError:
+        return filename, False, False, lambda: os.stat(filename)
+    if stat.S_ISDIR(status.st_mode):
+        return filename, True, False, None
+    if stat.S_ISLNK(status.st_mode):
+        return filename, os.path.isdir(filename), True, \
+            lambda: os.stat(filename)
+    return filename, False, False, lambda: status
+
+def _stat_file(filename, get_stat, quiet = None):
+    """Returns the stat of a file, following symlinks,
+    or None if we do not have permission to read it."""
+    try:
+        return get_stat()
+    except OSError:
+        # File Errors
+        if not os.access(filename, os.R_OK):
+            # If we don't have permission to read the file.
+            if not quiet:
+                print >> sys.stderr, \
+                    "We do not have permission to read", filename
+            return None
+        elif os.path.islink(filename):
+            # If the file is a broken symlink.
+            if not quiet:
+                print >> sys.stderr, "Warning the following symlink", \
+                    filename, "appears to be broken."
+            return os.lstat(filename)
+        else:
+            # Some other problem, lets just give up.
+            raise
+
+def write_entries(entries, fields = ('path',), output_format = 'text',
+                  output = None, flush = False):
+    r"""Writes out (filename, mtime, size, inode) tuples in one of FORMATS,
+    giving the named FIELDS of each.
+
+    text is separated by spaces with the mtime as a date and time,
+    nul ends every field with a NUL byte, json writes an object per line
+    and csv writes a header and then a row per file. A file that has
+    gone has an mtime of None, written as 'deleted' in text and as
+    empty or null otherwise. Unless flush is true, the output is
+    written BUFFER_SIZE bytes at a time.
+
+    >>> from StringIO import StringIO
+    >>> entries = [('a,b', 1.5, 10, 7), ('a "b" c', 2.0, 0, 8),
+    ...            ('gone', None, None, None)]
+    >>> output = StringIO()
+    >>> write_entries(entries, ('path', 'mtime', 'size'), 'csv', output)
+    >>> for line in output.getvalue().split('\r\n'):
+    ...     print line
+    path,mtime,size
+    "a,b",1.500000,10
+    "a ""b"" c",2.000000,0
+    gone,,
+    <BLANKLINE>
+    >>> output = StringIO()
+    >>> write_entries([('caf\xe9', 1.5, 3, 4), ('gone', None, None, None)],
+    ...               ('path', 'mtime'), 'json', output)
+    >>> print output.getvalue(),
+    {"path": "caf\ufffd", "mtime": 1.500000}
+    {"path": "gone", "mtime": null}
+    >>> output = StringIO()
+    >>> write_entries(entries[1:], ('path', 'inode'), 'nul', output)
+    >>> output.getvalue()
+    'a "b" c\x008\x00gone\x00\x00'
+    >>> write_entries(entries[2:], ('path', 'mtime'))
+    gone deleted
+    >>> write_entries(entries[2:])
+    """
+    if output is None:
+        output = sys.stdout
+    format_entry = _entry_formatter(fields, output_format)
+    if output_format == 'csv':
+        output.write(','.join(fields) + '\r\n')
+    entries = iter(entries)
+    chunk = []
+    buffered = 0
+    while True:
+        batch = list(itertools.islice(entries, 1 if flush else 1024))
+        if not batch:
+            break
+        text = ''.join([line for line in map(format_entry, batch) if line])
+        chunk.append(text)
+        buffered += len(text)
+        if flush or buffered >= BUFFER_SIZE:
+            output.write(''.join(chunk))
+            if flush:
+                output.flush()
+            del chunk[:]
+            buffered = 0
+    output.write(''.join(chunk))
+    output.flush()
+
+def _entry_formatter(fields, output_format):
+    """Returns a function that turns an entry into a line of output,
+    or None for a text line that should be left out."""
+    if output_format not in FORMATS:
+        raise ValueError("Unknown output format %r." % output_format)
+    columns = [FIELDS.index(field) for field in fields]
+    specs, converters = zip(*[_FIELD_FORMATS[output_format][field]
+                              for field in fields])
+    # One % template for the line, and another for lines with gaps in.
+    template = _line_template(fields, specs, output_format)
+    gappy_template = _line_template(fields, ['%s'] * len(fields),
+                                    output_format)
+    converted = [(position, converter)
+                 for position, converter in enumerate(converters)
+                 if converter]
+    getter = operator.itemgetter(*columns)
+    single = len(columns) == 1
+    hide_deleted = output_format == 'text' and 'mtime' not in fields
+
+    def format_entry(entry):
+        """Fills in the template from the entry."""
+        if hide_deleted and entry[1] is None:
+            # Without the time there would be no sign it has gone.
+            return None
+        values = getter(entry)
+        if single:
+            values = (values,)
+        if None in values:
+            return gappy_template % tuple(
+                _NONE_TEXT[output_format] if value is None
+                else converter(value) if converter else _raw_field(value)
+                for value, converter in zip(values, converters))
+        if converted:
+            values = list(values)
+            for position, converter in converted:
+                values[position] = converter(values[position])
+            values = tuple(values)
+        return template % values
+
+    return format_entry
+
+def _line_template(fields, specs, output_format):
+    """Puts together the % template for a line of output."""
+    if output_format == 'text':
+        return ' '.join(specs) + '\n'
+    if output_format == 'nul':
+        return ''.join(spec + '\0' for spec in specs)
+    if output_format == 'json':
+        return '{%s}\n' % ', '.join('"%s": %s' % (field, spec)
+                                    for field, spec in zip(fields, specs))
+    return ','.join(specs) + '\r\n'
+
+def _raw_field(value):
+    """A field as text, with an mtime to the microsecond."""
+    if isinstance(value, float):
+        return '%.6f' % value
+    return str(value)
+
+def _text_time(raw_mtime):
+    """An mtime as a date and time."""
+    return str(datetime.datetime.fromtimestamp(raw_mtime))
+
+def _json_string(filename):
+    """A filename as a JSON string. Filenames that are not UTF-8 are
+    written with replacement characters, use nul output to get them
+    exactly."""
+    try:
+        return encode_basestring_ascii(filename)
+    except UnicodeDecodeError:
+        return encode_basestring_ascii(filename.decode('utf-8', 'replace'))
+
+def _csv_field(filename):
+    """A filename quoted as the csv module would."""
+    if (',' in filename or '"' in filename or '\n' in filename
+        or '\r' in filename):
+        return '"%s"' % filename.replace('"', '""')
+    return filename
+
+# The % spec and converter of each field, in each format. Integers are
+# quicker to format with %s than with %d. A double only holds about a
+# microsecond of an mtime, so that is as far as they are written.
+_FIELD_FORMATS = {
+    'text': {'path': ('%s', None), 'mtime': ('%s', _text_time),
+             'size': ('%s', None), 'inode': ('%s', None)},
+    'nul': {'path': ('%s', None), 'mtime': ('%.6f', None),
+            'size': ('%s', None), 'inode': ('%s', None)},
+    'json': {'path': ('%s', _json_string), 'mtime': ('%.6f', None),
+             'size': ('%s', None), 'inode': ('%s', None)},
+    'csv': {'path': ('%s', _csv_field), 'mtime': ('%.6f', None),
+            'size': ('%s', None), 'inode': ('%s', None)}}
+
+# How a missing value, such as the mtime of a deleted file, is written.
+_NONE_TEXT = {'text': 'deleted', 'nul': '', 'json': 'null', 'csv': ''}
+
+# How a Watcher follows files being created, changed, moved and deleted.
+# These need inotify, so doctest is only given them where it works.
+_WATCHER_TESTS = r"""
+>>> import shutil, tempfile
+>>> directory = tempfile.mkdtemp()
+>>> outside = tempfile.mkdtemp()
+>>> def touch(name, raw_mtime, below = directory):
+...     filename = os.path.join(below, name)
+...     open(filename, 'a').close()
+...     os.utime(filename, (raw_mtime, raw_mtime))
+>>> def show(changes):
+...     for raw_mtime, filename in changes:
+...         print raw_mtime, os.path.relpath(filename, directory)
+>>> def events():
+...     show(watcher._handle(watcher._read_events()))
+>>> os.mkdir(os.path.join(directory, 'sub'))
+>>> touch('old', 100)
+>>> touch('sub/deep', 200)
+>>> watcher = Watcher(directory)
+>>> show(watcher.newest())
+200.0 sub/deep
+100.0 old
+
+Creating and modifying files:
+
+>>> touch('new', 300)
+>>> events()
+300.0 new
+>>> touch('old', 250)
+>>> events()
+250.0 old
+
+Moving files and directories in and out:
+
+>>> touch('visitor', 150, outside)
+>>> os.rename(os.path.join(outside, 'visitor'),
+...           os.path.join(directory, 'sub', 'visitor'))
+>>> events()
+150.0 sub/visitor
+>>> os.rename(os.path.join(directory, 'new'), os.path.join(outside, 'new'))
+>>> events()
+None new
+>>> os.mkdir(os.path.join(outside, 'tree'))
+>>> touch('tree/leaf', 50, outside)
+>>> os.rename(os.path.join(outside, 'tree'), os.path.join(directory, 'tree'))
+>>> events()
+50.0 tree/leaf
+>>> touch('tree/leaf', 60)
+>>> events()
+60.0 tree/leaf
+>>> os.rename(os.path.join(directory, 'sub'), os.path.join(outside, 'sub'))
+>>> events()
+None sub/deep
+None sub/visitor
+
+Deleting them:
+
+>>> os.remove(os.path.join(directory, 'old'))
+>>> shutil.rmtree(os.path.join(directory, 'tree'))
+>>> events()
+None old
+None tree/leaf
+>>> show(watcher.newest())
+>>> watcher.close()
+>>> shutil.rmtree(directory); shutil.rmtree(outside)
+"""
+
+__test__ = {}
+try:
+    _inotify()
+    __test__['Watcher'] = _WATCHER_TESTS
+except OSError:
+    pass
 
 def main():
     """Print out modified files within the directory."""
@@ -73,29 +1064,117 @@ def main():
                       action="store", type="int", dest="lines",
                       default=False,
                       help="output the last N lines")
+    parser.add_option("-j", "--threads",
+                      action="store", type="int", dest="threads",
+                      default=THREADS,
+                      help="scan directories with N threads")
+    parser.add_option("-s", "--since",
+                      action="store", dest="since",
+                      default=None,
+                      help="only files modified since a date or an age, "
+                      "e.g. 2009-06-30 or 12h")
+    parser.add_option("-x", "--index",
+                      action="store", dest="index",
+                      default=None,
+                      help="keep an index of the tree in FILE and only "
+                      "rescan directories that have changed")
+    parser.add_option("--rebuild",
+                      action="store_true", dest="rebuild",
+                      default=False,
+                      help="rebuild the index from scratch")
+    parser.add_option("-w", "--watch",
+                      action="store_true", dest="watch",
+                      default=False,
+                      help="keep printing files as they change, "
+                      "like tail -f, using Linux inotify")
+    parser.add_option("-f", "--format",
+                      action="store", type="choice", dest="format",
+                      choices=FORMATS, default='text',
+                      help="write text, nul (NUL after every field), "
+                      "json (JSON Lines) or csv")
+    parser.add_option("--fields",
+                      action="store", dest="fields",
+                      default=None,
+                      help="comma separated fields to write out of "
+                      + ", ".join(FIELDS) + "; the default is path, "
+                      "and mtime as well with -v")
+    parser.add_option("--test",
+                      action="store_true", dest="test",
+                      default=False,
+                      help="run the doctests, verbosely with -v")
     (options, args) = parser.parse_args()
 
+    if options.test:
+        import doctest
+        doctest.testmod(verbose = options.verbose)
+        return
+
+    if options.fields:
+        fields = tuple(options.fields.split(','))
+        for field in fields:
+            if field not in FIELDS:
+                parser.error("Unknown field %r." % field)
+    elif options.verbose:
+        fields = ('path', 'mtime')
+    else:
+        fields = ('path',)
+
+    index = None
+    if options.index:
+        index = MtimeIndex(options.index, options.rebuild)
+    elif options.rebuild:
+        parser.error("--rebuild needs an --index file.")
+
     if args:
         path = args[0]
     else:
         path = os.getcwd()
-    myhist = ModifyHist(path, options.quiet)
 
-    if options.lines:
-        for i in myhist.keys()[:options.lines]:
-            if options.verbose:
-                print myhist[i], i
-            else:
-                print myhist[i]
+    since = None
+    if options.since:
+        try:
+            since = parse_since(options.since)
+        except ValueError, error:
+            parser.error(str(error))
 
+    if options.watch:
+        try:
+            watcher = Watcher(path, options.quiet, options.threads)
+        except OSError, error:
+            sys.exit("Cannot watch %s: %s" % (path, error.strerror))
+        entries = watch(watcher, options.lines or 10, since,
+                        'size' in fields or 'inode' in fields)
+    elif options.lines or options.since:
+        # Stream the walk through a bounded heap.
+        entries = recent_files(path, options.lines or None, since,
+                               options.quiet, options.threads, index)
     else:
-        for i in myhist.keys():
-            if options.verbose:
-                print myhist[i], i
-            else:
-                print myhist[i]
+        entries = ModifyHist(path, options.quiet, options.threads,
+                             index).entries()
+
+    try:
+        write_entries(entries, fields, options.format, flush = options.watch)
+    except KeyboardInterrupt:
+        pass
+
+def watch(watcher, count = 10, since = None, with_stat = False):
+    """Yields the newest files, oldest first, then each one as it changes,
+    as (filename, mtime, size, inode) tuples. The watcher only keeps
+    mtimes, so the size and inode are None unless with_stat is true."""
+    try:
+        newest = reversed(watcher.newest(count, since))
+        for raw_mtime, filename in itertools.chain(newest, watcher.changes()):
+            size = inode = None
+            if with_stat and raw_mtime is not None:
+                try:
+                    status = os.stat(filename)
+                    size, inode = status.st_size, status.st_ino
+                except OSError:
+                    pass
+            yield filename, raw_mtime, size, inode
+    finally:
+        watcher.close()
 
 # start the ball rolling
-if __name__ == "__main__": 
+if __name__ == "__main__":
     main()
-
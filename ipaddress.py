@@ -1,7 +1,8 @@
 """ipaddress.py - IP address operations.
 These functions deal with IPv4 addresses in integer forms.
 This is useful in interoperating with MySQL/PHP applications
-where these integer forms seem to be popular."""
+where these integer forms seem to be popular.
+IPv6 addresses and CIDR blocks are handled as 128 bit integers."""
 
 # Redistribution and use in source and binary forms, 
 # with or without modification, are permitted, subject
@@ -18,8 +19,32 @@ __author__ = 'Zeth'
 __copyright__ = 'Copyright (C) 2009'
 __version__ = '0.1'
 
-from socket import inet_ntoa, inet_aton
-from struct import pack, unpack
+from socket import inet_ntoa, inet_aton, inet_pton, inet_ntop, AF_INET6
+from struct import pack, unpack, error as pack_error
+from array import array
+import sys
+import mmap
+from sys import byteorder
+from bisect import bisect_right
+from heapq import heappush, heappop
+from itertools import izip
+import cPickle
+
+# NumPy is optional, the batch functions use it when it is there.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The array typecode of a 32 bit unsigned integer. 
+# 'L' is 64 bits on most 64 bit platforms, so use 'I' where it will do.
+if array('I').itemsize == 4:
+    IP_TYPECODE = 'I'
+else:
+    IP_TYPECODE = 'L'
+
+# What pack() says about an integer too big or small for an IPv4 address.
+_RANGE_ERROR = "'L' format requires 0 <= number <= 4294967295"
 
 def dot_to_int(dotted_string):
     """Converts an IPv4 Internet address in dotted notation, 
@@ -45,6 +70,144 @@ def int_to_dot(ip_integer):
     packed_long = pack('!L', long(ip_integer))
     return inet_ntoa(packed_long)
 
+def ipv6_to_int(ipv6_string):
+    """Converts an IPv6 Internet address in colon notation, 
+    e.g. 2001:db8::1, to a 128 bit integer.
+
+    For example:
+
+    >>> ipv6_to_int('::1')
+    1
+    >>> ipv6_to_int('2001:db8::1')
+    42540766411282592856903984951653826561L
+    """
+    high, low = unpack('!QQ', inet_pton(AF_INET6, ipv6_string))
+    return (high << 64) | low
+
+def int_to_ipv6(ip_integer):
+    """Converts an IPv6 Internet address in integer form 
+    to colon notation.
+
+    For example:
+
+    >>> int_to_ipv6(42540766411282592856903984951653826561L)
+    '2001:db8::1'
+    """
+    ip_integer = long(ip_integer)
+    packed = pack('!QQ', ip_integer >> 64, ip_integer & 0xffffffffffffffff)
+    return inet_ntop(AF_INET6, packed)
+
+def parse_address(ip_address):
+    """Converts an IPv4 or IPv6 address to a tuple of 
+    the IP version and the integer form.
+
+    >>> parse_address('127.0.0.1')
+    (4, 2130706433)
+    >>> parse_address('::1')
+    (6, 1)
+    """
+    if ':' in ip_address:
+        return 6, ipv6_to_int(ip_address)
+    return 4, dot_to_int(ip_address)
+
+def parse_cidr(cidr_string):
+    """Converts a CIDR block, e.g. 192.168.0.0/16, to a tuple 
+    of the IP version, network address in integer form and 
+    prefix length. Any host bits are cleared. An address 
+    without a prefix length is taken as a single host.
+
+    For example:
+
+    >>> parse_cidr('192.168.0.0/16')
+    (4, 3232235520L, 16)
+    >>> parse_cidr('2001:db8::/32')
+    (6, 42540766411282592856903984951653826560L, 32)
+    >>> parse_cidr('10.1.2.3/8') == parse_cidr('10.0.0.0/8')
+    True
+    """
+    if '/' in cidr_string:
+        address, prefix_length = cidr_string.split('/', 1)
+        prefix_length = int(prefix_length)
+    else:
+        address, prefix_length = cidr_string, None
+    version, ip_integer = parse_address(address)
+    bits = _BITS[version]
+    if prefix_length is None:
+        prefix_length = bits
+    if not 0 <= prefix_length <= bits:
+        raise ValueError("Bad prefix length in %s." % cidr_string)
+    host_bits = bits - prefix_length
+    return version, (long(ip_integer) >> host_bits) << host_bits, \
+        prefix_length
+
+def dots_to_ints(dotted_strings):
+    """Converts many IPv4 Internet addresses in dotted notation 
+    to integer form in one go.
+
+    The addresses are packed into one string of bytes, which is 
+    then read as an array of integers all at once. It returns a 
+    NumPy array of uint32 if NumPy is installed, otherwise an 
+    array.array of 32 bit unsigned integers.
+
+    For example:
+
+    >>> ips = dots_to_ints(['127.0.0.1', '192.168.5.100'])
+    >>> list(ips) == [dot_to_int('127.0.0.1'), dot_to_int('192.168.5.100')]
+    True
+    """
+    packed_binary = ''.join(map(inet_aton, dotted_strings))
+    if numpy is not None:
+        return numpy.frombuffer(packed_binary, '>u4').astype(numpy.uint32)
+    ip_integers = array(IP_TYPECODE)
+    ip_integers.fromstring(packed_binary)
+    if byteorder == 'little':
+        ip_integers.byteswap()
+    return ip_integers
+
+def ints_to_dots(ip_integers):
+    """Converts many IPv4 Internet addresses in integer form 
+    to dotted notation in one go.
+
+    It takes the output of dots_to_ints(), or any iterable of 
+    integers, and returns a list of strings.
+
+    For example:
+
+    >>> ints_to_dots([2130706433, 3232236900])
+    ['127.0.0.1', '192.168.5.100']
+    >>> ints_to_dots(dots_to_ints(['10.0.0.1', '255.255.255.255']))
+    ['10.0.0.1', '255.255.255.255']
+
+    Out of range integers raise the same error as int_to_dot():
+
+    >>> ints_to_dots([2 ** 32 + 5])
+    Traceback (most recent call last):
+    ...
+    error: 'L' format requires 0 <= number <= 4294967295
+    """
+    if numpy is not None and isinstance(ip_integers, numpy.ndarray):
+        # astype() would wrap them round without a word.
+        if len(ip_integers) and (ip_integers.min() < 0 or 
+                                 ip_integers.max() > 0xFFFFFFFF):
+            raise pack_error(_RANGE_ERROR)
+        packed_longs = ip_integers.astype('>u4').tostring()
+    else:
+        if isinstance(ip_integers, array) and \
+                ip_integers.typecode == IP_TYPECODE:
+            # Copy it, so the byteswap leaves the caller's array alone.
+            ip_integers = array(IP_TYPECODE, ip_integers)
+        else:
+            try:
+                ip_integers = array(IP_TYPECODE, 
+                                    [long(i) for i in ip_integers])
+            except OverflowError:
+                raise pack_error(_RANGE_ERROR)
+        if byteorder == 'little':
+            ip_integers.byteswap()
+        packed_longs = ip_integers.tostring()
+    return [inet_ntoa(packed_longs[i:i + 4]) 
+            for i in xrange(0, len(packed_longs), 4)]
+
 def ip_in_range(ip_address, from_address, to_address):
     """Tests whether the *ip_address* is between the 
     *from_address* and *to_address*.
@@ -56,14 +219,671 @@ def ip_in_range(ip_address, from_address, to_address):
     >>> ip_in_range('127.0.0.1', '192.168.0.1', '192.168.255.255')
     False
     """
-    iprange = xrange(dot_to_int(from_address), 
-                     dot_to_int(to_address)) 
-    if dot_to_int(ip_address) in iprange:
-        return True
+    ip_integer = dot_to_int(ip_address)
+    return dot_to_int(from_address) <= ip_integer < dot_to_int(to_address)
+
+def _to_int(ip_address):
+    """Returns the integer form of an address that may be in 
+    either dotted notation or integer form.
+
+    >>> _to_int('127.0.0.1'), _to_int(2130706433)
+    (2130706433, 2130706433)
+    """
+    if isinstance(ip_address, basestring):
+        return dot_to_int(ip_address)
+    return ip_address
+
+class IPRangeIndex(object):
+    """Looks up addresses in a large table of address ranges.
+
+    The ranges are given as (from_address, to_address, payload) 
+    tuples, with the addresses in dotted notation or integer form. 
+    Unlike ip_in_range(), both ends of each range are included. 
+
+    Ranges may overlap. The table is split into pieces that do 
+    not overlap, each holding the payload of the narrowest range 
+    that covers it, and these are searched by bisection. 
+
+    For example:
+
+    >>> index = IPRangeIndex([('10.0.0.0', '10.255.255.255', 'private'),
+    ...                       ('10.1.0.0', '10.1.255.255', 'office'),
+    ...                       ('192.168.0.0', '192.168.255.255', 'home')])
+    >>> index.lookup('10.1.2.3')
+    'office'
+    >>> index.lookup('10.2.0.1')
+    'private'
+    >>> index.lookup('8.8.8.8') is None
+    True
+    >>> index.lookup_many(['192.168.0.1', '10.1.0.0', '11.0.0.0'])
+    ['home', 'office', None]
+    """
+
+    def __init__(self, ranges = ()):
+        """Builds the index from an iterable of ranges."""
+        self.payloads = []
+        self.starts = array(IP_TYPECODE)
+        self.ends = array(IP_TYPECODE)
+        self.indices = array(IP_TYPECODE)
+        self._numpy_arrays = None
+
+        boundaries = set()
+        by_start = []
+        for from_address, to_address, payload in ranges:
+            from_integer = _to_int(from_address)
+            to_integer = _to_int(to_address)
+            by_start.append((from_integer, to_integer, len(self.payloads)))
+            self.payloads.append(payload)
+            boundaries.add(from_integer)
+            boundaries.add(to_integer + 1)
+        by_start.sort(reverse = True)
+
+        # Sweep along the boundaries, keeping a heap of the ranges 
+        # that have started, narrowest first. Between one boundary 
+        # and the next the covering ranges do not change.
+        boundaries = sorted(boundaries)
+        active = []
+        for position, boundary in enumerate(boundaries[:-1]):
+            while by_start and by_start[-1][0] == boundary:
+                from_integer, to_integer, payload = by_start.pop()
+                heappush(active, (to_integer - from_integer, payload, 
+                                  to_integer))
+            while active and active[0][2] < boundary:
+                heappop(active)
+            if not active:
+                continue
+            payload = active[0][1]
+            last = boundaries[position + 1] - 1
+            if self.indices and self.indices[-1] == payload and \
+                    self.ends[-1] == boundary - 1:
+                # Carry on the previous piece.
+                self.ends[-1] = last
+            else:
+                self.starts.append(boundary)
+                self.ends.append(last)
+                self.indices.append(payload)
+
+    def lookup(self, ip_address, default = None):
+        """Returns the payload of the narrowest range containing 
+        the address, or default if there is none. Where ranges 
+        of the same size overlap, the first one given wins."""
+        ip_integer = _to_int(ip_address)
+        position = bisect_right(self.starts, ip_integer) - 1
+        if position >= 0 and ip_integer <= self.ends[position]:
+            return self.payloads[self.indices[position]]
+        return default
+
+    def lookup_many(self, ip_addresses, default = None):
+        """Looks up many addresses, returning a list of payloads.
+
+        The addresses can be in dotted notation, integer form or 
+        the output of dots_to_ints(). With NumPy installed the 
+        whole batch is searched at once."""
+        if numpy is None or not self.starts:
+            return [self.lookup(ip_address, default) 
+                    for ip_address in ip_addresses]
+        if not isinstance(ip_addresses, (numpy.ndarray, array)):
+            ip_addresses = list(ip_addresses)
+            if ip_addresses and isinstance(ip_addresses[0], basestring):
+                ip_addresses = dots_to_ints(ip_addresses)
+        ip_integers = numpy.asarray(ip_addresses, numpy.int64)
+        if self._numpy_arrays is None:
+            self._numpy_arrays = (numpy.array(self.starts, numpy.int64),
+                                  numpy.array(self.ends, numpy.int64),
+                                  numpy.array(self.indices, numpy.int64))
+        starts, ends, indices = self._numpy_arrays
+        positions = numpy.searchsorted(starts, ip_integers, 'right') - 1
+        found = (positions >= 0) & \
+            (ip_integers <= ends[numpy.maximum(positions, 0)])
+        payloads = self.payloads
+        return [payloads[index] if found_one else default
+                for found_one, index 
+                in zip(found, indices[numpy.maximum(positions, 0)])]
+
+    def save(self, filename):
+        """Writes the index to a file that load() can read back 
+        without building it again. The payloads are pickled.
+
+        >>> index = IPRangeIndex([('10.0.0.0', '10.0.0.255', 'lan')])
+        >>> index.save('test.index')
+        >>> IPRangeIndex.load('test.index').lookup('10.0.0.7')
+        'lan'
+        >>> import os; os.remove('test.index')
+        """
+        index_file = open(filename, 'wb')
+        index_file.write(_INDEX_MAGIC + pack('!L', len(self.starts)))
+        for column in (self.starts, self.ends, self.indices):
+            column = array(IP_TYPECODE, column)
+            if byteorder == 'little':
+                column.byteswap()
+            column.tofile(index_file)
+        cPickle.dump(self.payloads, index_file, cPickle.HIGHEST_PROTOCOL)
+        index_file.close()
+
+    @classmethod
+    def load(cls, filename):
+        """Reads an index written by save()."""
+        index_file = open(filename, 'rb')
+        if index_file.read(len(_INDEX_MAGIC)) != _INDEX_MAGIC:
+            raise ValueError("%s is not an IPRangeIndex file." % filename)
+        count = unpack('!L', index_file.read(4))[0]
+        index = cls()
+        for column in (index.starts, index.ends, index.indices):
+            column.fromfile(index_file, count)
+            if byteorder == 'little':
+                column.byteswap()
+        index.payloads = cPickle.load(index_file)
+        index_file.close()
+        return index
+
+_INDEX_MAGIC = 'IPRI'
+
+class IPRangeSet(object):
+    """A set of IPv4 addresses held as sorted, merged ranges.
+
+    The ranges are given as (from_address, to_address) tuples in 
+    dotted notation or integer form, with both ends included. 
+    Overlapping and adjacent ranges are merged, so sets of raw 
+    ranges can be collapsed before they are turned into rules.
+
+    For example:
+
+    >>> rules = IPRangeSet([('10.0.0.0', '10.0.0.127'), 
+    ...                     ('10.0.0.128', '10.0.0.255'),
+    ...                     ('10.0.0.10', '10.0.0.20')])
+    >>> rules
+    IPRangeSet([('10.0.0.0', '10.0.0.255')])
+    >>> rules.to_cidrs()
+    ['10.0.0.0/24']
+    >>> rules - IPRangeSet.from_cidrs(['10.0.0.64/26'])
+    IPRangeSet([('10.0.0.0', '10.0.0.63'), ('10.0.0.128', '10.0.0.255')])
+    >>> '10.0.0.7' in rules
+    True
+    """
+
+    def __init__(self, ranges = ()):
+        """Merges the ranges, sorting them first."""
+        ranges = sorted((_to_int(from_address), _to_int(to_address))
+                        for from_address, to_address in ranges)
+        self._ranges = []
+        for start, end in ranges:
+            if self._ranges and start <= self._ranges[-1][1] + 1:
+                if end > self._ranges[-1][1]:
+                    self._ranges[-1] = (self._ranges[-1][0], end)
+            else:
+                self._ranges.append((start, end))
+
+    @classmethod
+    def _from_merged(cls, ranges):
+        """Makes a set from ranges that are already sorted and merged."""
+        range_set = cls()
+        range_set._ranges = ranges
+        return range_set
+
+    @classmethod
+    def from_cidrs(cls, cidr_strings):
+        """Makes a set from IPv4 CIDR blocks, e.g. 10.0.0.0/8."""
+        ranges = []
+        for cidr_string in cidr_strings:
+            version, network, prefix_length = parse_cidr(cidr_string)
+            if version != 4:
+                raise ValueError("%s is not an IPv4 block." % cidr_string)
+            ranges.append((network, network + 2 ** (32 - prefix_length) - 1))
+        return cls(ranges)
+
+    def to_cidrs(self):
+        """Returns the fewest CIDR blocks that cover the set.
+
+        >>> IPRangeSet([('10.0.0.1', '10.0.0.6')]).to_cidrs()
+        ['10.0.0.1/32', '10.0.0.2/31', '10.0.0.4/31', '10.0.0.6/32']
+        >>> IPRangeSet([('0.0.0.0', '255.255.255.255')]).to_cidrs()
+        ['0.0.0.0/0']
+        """
+        cidrs = []
+        for start, end in self._ranges:
+            while start <= end:
+                # The biggest block that is aligned at start and fits.
+                size = (start & -start) or 2 ** 32
+                while size > end - start + 1:
+                    size //= 2
+                cidrs.append('%s/%d' % (int_to_dot(start), 
+                                        33 - size.bit_length()))
+                start += size
+        return cidrs
+
+    def __iter__(self):
+        """Iterates over the (start, end) ranges in integer form."""
+        return iter(self._ranges)
+
+    def __len__(self):
+        """The number of ranges, not addresses."""
+        return len(self._ranges)
+
+    def __eq__(self, other):
+        return self._ranges == other._ranges
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'IPRangeSet(%r)' % [(int_to_dot(start), int_to_dot(end))
+                                   for start, end in self._ranges]
+
+    def __contains__(self, ip_address):
+        ip_integer = _to_int(ip_address)
+        position = bisect_right(self._ranges, (ip_integer, 2 ** 32)) - 1
+        return position >= 0 and ip_integer <= self._ranges[position][1]
+
+    def address_count(self):
+        """Returns the number of addresses in the set."""
+        return sum(end - start + 1 for start, end in self._ranges)
+
+    def union(self, other):
+        """Returns the addresses in either set.
+
+        >>> IPRangeSet([('10.0.0.0', '10.0.0.9')]) | \\
+        ...     IPRangeSet([('10.0.0.10', '10.0.0.20')])
+        IPRangeSet([('10.0.0.0', '10.0.0.20')])
+        """
+        return IPRangeSet(self._ranges + other._ranges)
+
+    def intersection(self, other):
+        """Returns the addresses in both sets.
+
+        >>> IPRangeSet([('10.0.0.0', '10.0.0.9')]) & \\
+        ...     IPRangeSet([('10.0.0.5', '10.0.0.20')])
+        IPRangeSet([('10.0.0.5', '10.0.0.9')])
+        """
+        ranges = []
+        mine = self._ranges
+        theirs = other._ranges
+        i = j = 0
+        while i < len(mine) and j < len(theirs):
+            start = max(mine[i][0], theirs[j][0])
+            end = min(mine[i][1], theirs[j][1])
+            if start <= end:
+                ranges.append((start, end))
+            # Move on from whichever range finishes first.
+            if mine[i][1] < theirs[j][1]:
+                i += 1
+            else:
+                j += 1
+        return self._from_merged(ranges)
+
+    def difference(self, other):
+        """Returns the addresses in this set but not the other."""
+        ranges = []
+        theirs = other._ranges
+        j = 0
+        for start, end in self._ranges:
+            # Skip the ranges that finish before this one starts.
+            while j < len(theirs) and theirs[j][1] < start:
+                j += 1
+            k = j
+            while k < len(theirs) and theirs[k][0] <= end:
+                if theirs[k][0] > start:
+                    ranges.append((start, theirs[k][0] - 1))
+                start = max(start, theirs[k][1] + 1)
+                k += 1
+            if start <= end:
+                ranges.append((start, end))
+        return self._from_merged(ranges)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+# The number of bits in an address of each IP version.
+_BITS = {4: 32, 6: 128}
+
+# Marks a trie node that is only a branch, not a stored prefix.
+_NO_PAYLOAD = object()
+
+class _TrieNode(object):
+    """A node of PrefixTrie. The key is the prefix shifted down 
+    by shift bits, the number of bits not in the prefix."""
+    __slots__ = ('key', 'shift', 'payload', 'children')
+
+    def __init__(self, key, shift, payload = _NO_PAYLOAD):
+        self.key = key
+        self.shift = shift
+        self.payload = payload
+        self.children = [None, None]
+
+class PrefixTrie(object):
+    """Longest prefix matching of addresses against CIDR blocks.
+
+    The prefixes are stored in a path compressed binary (Patricia) 
+    trie, one for IPv4 and one for IPv6. There is one node per 
+    stored prefix plus at most one branch node for each, and nodes 
+    use slots to keep them small.
+
+    Walking the trie a bit at a time is slow in Python, so the 
+    first lookup after an insert flattens the trie into a sorted 
+    table of the addresses where the longest match changes. A 
+    lookup is then a single bisection.
+
+    For example:
+
+    >>> trie = PrefixTrie()
+    >>> trie.insert('10.0.0.0/8', 'private')
+    >>> trie.insert('10.1.0.0/16', 'office')
+    >>> trie.insert('2001:db8::/32', 'documentation')
+    >>> trie.lookup('10.1.2.3')
+    'office'
+    >>> trie.lookup('10.2.0.1')
+    'private'
+    >>> trie.lookup('2001:db8::1')
+    'documentation'
+    >>> trie.lookup('8.8.8.8') is None
+    True
+    >>> trie.lookup(167838211, version = 4)
+    'office'
+    """
+
+    def __init__(self, prefixes = ()):
+        """Optionally takes an iterable of (cidr, payload) tuples."""
+        self._roots = {4: _TrieNode(0, 32), 6: _TrieNode(0, 128)}
+        self._tables = {4: None, 6: None}
+        self._numpy_starts = None
+        self._length = 0
+        for cidr, payload in prefixes:
+            self.insert(cidr, payload)
+
+    def __len__(self):
+        return self._length
+
+    def insert(self, cidr, payload):
+        """Stores the payload for a CIDR block, replacing any 
+        payload already stored for exactly the same block."""
+        version, network, prefix_length = parse_cidr(cidr)
+        shift = _BITS[version] - prefix_length
+        self._tables[version] = None
+        if version == 4:
+            self._numpy_starts = None
+        node = self._roots[version]
+        while True:
+            if node.shift == shift:
+                if node.payload is _NO_PAYLOAD:
+                    self._length += 1
+                node.payload = payload
+                return
+            bit = (network >> (node.shift - 1)) & 1
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = _TrieNode(network >> shift, shift, 
+                                               payload)
+                self._length += 1
+                return
+            # Find how many bits the child and the new prefix share.
+            difference = (child.key << child.shift) ^ network
+            common_shift = max(child.shift, shift, difference.bit_length())
+            if common_shift == child.shift:
+                node = child
+                continue
+            # Split the edge with a new node at the shared prefix.
+            branch = _TrieNode(network >> common_shift, common_shift)
+            child_bit = (child.key >> (common_shift - child.shift - 1)) & 1
+            branch.children[child_bit] = child
+            node.children[bit] = branch
+            if common_shift == shift:
+                branch.payload = payload
+            else:
+                branch.children[1 - child_bit] = _TrieNode(
+                    network >> shift, shift, payload)
+            self._length += 1
+            return
+
+    def lookup(self, ip_address, default = None, version = None):
+        """Returns the payload of the longest stored prefix that 
+        contains the address, or default if none does. The 
+        address can be a string, or an integer with the version."""
+        if version is None:
+            version, ip_address = parse_address(ip_address)
+        table = self._tables[version]
+        if table is None:
+            table = self._flatten(version)
+        payload = table[1][bisect_right(table[0], ip_address) - 1]
+        if payload is _NO_PAYLOAD:
+            return default
+        return payload
+
+    def lookup_many(self, ip_addresses, default = None, version = None):
+        """Looks up many addresses, returning a list of payloads.
+
+        Give the version to look up integers, such as the output 
+        of dots_to_ints(). With NumPy installed, a batch of IPv4 
+        integers is searched all at once.
+
+        >>> trie = PrefixTrie([('10.0.0.0/8', 'private')])
+        >>> trie.lookup_many(['10.0.0.1', '::1'])
+        ['private', None]
+        >>> trie.lookup_many(dots_to_ints(['10.0.0.1', '11.0.0.1']), 
+        ...                  version = 4)
+        ['private', None]
+        """
+        if version is None:
+            return [self.lookup(ip_address, default) 
+                    for ip_address in ip_addresses]
+        table = self._tables[version]
+        if table is None:
+            table = self._flatten(version)
+        starts, payloads = table
+        if numpy is not None and version == 4:
+            if self._numpy_starts is None:
+                self._numpy_starts = numpy.array(starts, numpy.int64)
+            positions = numpy.searchsorted(
+                self._numpy_starts, 
+                numpy.asarray(ip_addresses, numpy.int64), 'right') - 1
+            found = [payloads[position] for position in positions.tolist()]
+        else:
+            found = [payloads[bisect_right(starts, ip_address) - 1] 
+                     for ip_address in ip_addresses]
+        return [default if payload is _NO_PAYLOAD else payload 
+                for payload in found]
+
+    def _flatten(self, version):
+        """Builds the lookup table of one IP version from the trie.
+
+        >>> trie = PrefixTrie([('10.0.0.0/8', 'a'), ('10.0.0.0/16', 'b')])
+        >>> starts, payloads = trie._flatten(4)
+        >>> [int_to_dot(start) for start in starts]
+        ['0.0.0.0', '10.0.0.0', '10.1.0.0', '11.0.0.0']
+        >>> payloads[1:3]
+        ['b', 'a']
+        """
+        starts = []
+        payloads = []
+
+        def add(start, payload):
+            """Starts a new piece, unless the payload is unchanged."""
+            if payloads and payloads[-1] is payload:
+                return
+            starts.append(start)
+            payloads.append(payload)
+
+        def walk(node, payload):
+            """Adds the pieces inside the node, in order."""
+            if node.payload is not _NO_PAYLOAD:
+                payload = node.payload
+            position = node.key << node.shift
+            for child in node.children:
+                if child is None:
+                    continue
+                child_start = child.key << child.shift
+                if child_start > position:
+                    add(position, payload)
+                walk(child, payload)
+                position = (child.key + 1) << child.shift
+            if position < (node.key + 1) << node.shift:
+                add(position, payload)
+
+        walk(self._roots[version], _NO_PAYLOAD)
+        self._tables[version] = starts, payloads
+        return starts, payloads
+
+# How much of a log file the command line filter handles at a time.
+BLOCK_SIZE = 4 * 2 ** 20
+
+# The errors a bad address can cause in the conversion functions.
+_ADDRESS_ERRORS = (EnvironmentError, ValueError, OverflowError, TypeError)
+
+def load_ranges(filename):
+    """Makes an IPRangeIndex from a file written by IPRangeIndex.save(), 
+    or from a text file of lines with the first address, the last 
+    address and then the payload, separated by whitespace."""
+    range_file = open(filename, 'rb')
+    if range_file.read(len(_INDEX_MAGIC)) == _INDEX_MAGIC:
+        range_file.close()
+        return IPRangeIndex.load(filename)
+    range_file.seek(0)
+    ranges = []
+    for line in range_file:
+        parts = line.split(None, 2)
+        if len(parts) == 3:
+            ranges.append((_to_address(parts[0]), _to_address(parts[1]), 
+                           parts[2].rstrip('\r\n')))
+    range_file.close()
+    return IPRangeIndex(ranges)
+
+def _to_address(text):
+    """Turns integer form in a text file into an integer, 
+    leaving dotted notation alone."""
+    if text.isdigit():
+        return long(text)
+    return text
+
+def read_blocks(input_file, block_size = BLOCK_SIZE):
+    """Yields blocks of whole lines from a file. Regular files are 
+    memory-mapped, pipes are read in the usual way. Only one block 
+    is held in memory at a time."""
+    try:
+        source = mmap.mmap(input_file.fileno(), 0, access = mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError, mmap.error):
+        # Pipes and empty files cannot be mapped.
+        source = input_file
+    rest = ''
+    while True:
+        block = source.read(block_size)
+        if not block:
+            if rest:
+                yield rest
+            return
+        block = rest + block
+        end = block.rfind('\n') + 1
+        rest = block[end:]
+        if end:
+            yield block[:end]
+
+def _convert_all(function, values, default):
+    """Applies a batch function to the values, falling back to one 
+    value at a time if the batch has a bad address in it."""
+    try:
+        return function(values)
+    except _ADDRESS_ERRORS:
+        results = []
+        for value in values:
+            try:
+                results.append(function([value])[0])
+            except _ADDRESS_ERRORS:
+                results.append(default(value))
+        return results
+
+def convert_block(block, column, delimiter, to_int = True):
+    """Rewrites one column of every line in a block of text 
+    between dotted notation and integer form. Lines without 
+    the column, or with a bad address in it, are left alone.
+
+    >>> convert_block('127.0.0.1 - GET\\n10.0.0.1 - PUT\\n', 0, ' ')
+    '2130706433 - GET\\n167772161 - PUT\\n'
+    >>> convert_block('2130706433,x\\nbad,y\\n', 0, ',', to_int = False)
+    '127.0.0.1,x\\nbad,y\\n'
+    """
+    rows = [line.split(delimiter) for line in block.split('\n')]
+    wanted = [row for row in rows if len(row) > column and row[column]]
+    if to_int:
+        function = dots_to_ints
+    else:
+        function = ints_to_dots
+    values = _convert_all(function, [row[column] for row in wanted], 
+                          lambda value: value)
+    for row, value in izip(wanted, values):
+        row[column] = str(value)
+    return '\n'.join([delimiter.join(row) for row in rows])
+
+def tag_block(block, column, delimiter, index):
+    """Adds the payload of the matching range in the index, or a 
+    dash, to the end of every line in a block of text.
+
+    >>> index = IPRangeIndex([('10.0.0.0', '10.255.255.255', 'private')])
+    >>> tag_block('10.0.0.1 GET\\n8.8.8.8 GET\\n', 0, ' ', index)
+    '10.0.0.1 GET private\\n8.8.8.8 GET -\\n'
+    """
+    rows = [line.split(delimiter) for line in block.split('\n')]
+    wanted = [row for row in rows if len(row) > column and row[column]]
+    payloads = _convert_all(index.lookup_many, 
+                            [row[column] for row in wanted], 
+                            lambda value: None)
+    for row, payload in izip(wanted, payloads):
+        if payload is None:
+            row.append('-')
+        else:
+            row.append(str(payload))
+    return '\n'.join([delimiter.join(row) for row in rows])
+
+def main():
+    """Filters log files, or runs the doctests if no action is given."""
+    from optparse import OptionParser
+    usage = "usage: %prog [options] [log files]"
+    parser = OptionParser(usage = usage)
+    parser.add_option("-i", "--to-int",
+                      action="store_true", dest="to_int",
+                      default=False,
+                      help="rewrite the column from dotted to integer form")
+    parser.add_option("-t", "--to-dot",
+                      action="store_true", dest="to_dot",
+                      default=False,
+                      help="rewrite the column from integer to dotted form")
+    parser.add_option("-r", "--ranges",
+                      action="store", dest="ranges",
+                      default=None,
+                      help="tag each line with the matching range from FILE")
+    parser.add_option("-c", "--column",
+                      action="store", type="int", dest="column",
+                      default=1,
+                      help="the column holding the address, from 1")
+    parser.add_option("-d", "--delimiter",
+                      action="store", dest="delimiter",
+                      default=" ",
+                      help="the column delimiter, a space by default")
+    parser.add_option("-v", "--verbose",
+                      action="store_true", dest="verbose",
+                      default=False,
+                      help="verbose output when running the doctests")
+    (options, args) = parser.parse_args()
+
+    if not (options.to_int or options.to_dot or options.ranges):
+        import doctest
+        doctest.testmod(verbose = options.verbose)
+        return
+
+    column = options.column - 1
+    if options.ranges:
+        index = load_ranges(options.ranges)
+        process = lambda block: tag_block(block, column, 
+                                          options.delimiter, index)
+    else:
+        process = lambda block: convert_block(block, column, 
+                                              options.delimiter, 
+                                              options.to_int)
+    if args:
+        input_files = [open(filename, 'rb') for filename in args]
     else:
-        return False
+        input_files = [sys.stdin]
+    for input_file in input_files:
+        for block in read_blocks(input_file):
+            sys.stdout.write(process(block))
 
 if __name__ == "__main__":
-    import doctest
-    doctest.testmod()
+    main()
 
@@ -1,12 +1,109 @@
 """Friendly Python SSH2 interface."""
 
 import os
+import sys
+import json
+import zlib
+import math
+import mmap
+import stat
+import time
+import pipes
+import struct
+import hashlib
+import logging
+import Queue
+import select
+import socket
 import tempfile
+import subprocess
+import threading
+from contextlib import contextmanager
+from collections import namedtuple, deque
+from cStringIO import StringIO
 import paramiko
 
+# numpy makes sync() quicker at finding blocks that have moved,
+# if it is there.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# OpenSSH servers allow ten sessions on a connection by default.
+MAX_CHANNELS = 10
+
+# A ConnectionPool keeps this many connections open at most,
+# and has them send keepalives every CHECK_INTERVAL seconds.
+MAX_CONNECTIONS = 50
+CHECK_INTERVAL = 30
+
+# Transfers use this many SFTP sessions at once, and split files into
+# ranges of RANGE_SIZE bytes to be sent over different sessions.
+SFTP_CHANNELS = 4
+RANGE_SIZE = 2 ** 23
+
+# The most that paramiko puts in one SFTP read or write request.
+SFTP_CHUNK = 32768
+
+# Streamed command output is read this many bytes at a time.
+STREAM_CHUNK = 2 ** 15
+
+# run_many works on this many hosts at once.
+CONCURRENCY = 20
+
+# A ControlMaster shares its connection for this many seconds
+# after its last client has gone.
+CONTROL_PERSIST = 600
+
+# paramiko logs to a temporary file at this level. Logging every
+# packet at DEBUG slows connecting and transfers down noticeably.
+LOG_LEVEL = logging.WARNING
+
+# Metrics counts an operation that takes SLOW_SECONDS or more as slow,
+# and works out percentiles from the last METRIC_SAMPLES of each kind.
+SLOW_SECONDS = 1.0
+METRIC_SAMPLES = 10000
+
+# Private keys that have been read, by filename, with the time each
+# file was changed, so that each is only parsed once.
+_KEYS = {}
+_KEYS_LOCK = threading.Lock()
+_LOGGING_LOCK = threading.Lock()
+
+# Runs _control_daemon() from this module in a new process.
+_CONTROL_COMMAND = ('import sys; sys.path.insert(0, %(directory)r); '
+                    'import %(module)s; %(module)s._control_daemon()')
+
+# What run_many gives back for each host: the output of the command or
+# the exception that stopped it, and how many seconds were spent
+# connecting, authenticating and executing. A phase that was not
+# reached is None.
+HostResult = namedtuple('HostResult',
+                        'host output error connect auth execute')
+
 class Connection(object):
     """Connects and logs into the specified hostname. 
-    Arguments that are not given are guessed from the environment.""" 
+    Arguments that are not given are guessed from the environment.
+    If a timeout is given, connecting and logging in must be done within
+    that many seconds. The seconds each took are kept in timings.
+
+    If lazy is True, nothing is done until the connection is first used.
+    If a control_path is given, commands and transfers go through the
+    ControlMaster listening there, which is started in the background
+    if there is not one already, so that later Connections to the same
+    host, even from other processes, do not have to connect and log in
+    again. It keeps going for control_persist seconds after it is last
+    used. The path should be in a directory only you can write to.
+    A ControlMaster there for another user, host or port is left alone,
+    and the Connection connects by itself.
+
+    If given, metrics(host, operation, seconds, size, detail) is called
+    as each operation finishes: 'connect', 'auth', 'channel' to open a
+    channel, 'execute' to run a command, with the bytes it output and
+    the command as the detail, 'sftp' to open an SFTP session, and
+    'get' or 'put', with the bytes copied. Operations that fail are not
+    counted. A Metrics will collect them.""" 
 
     def __init__(self,
                  host,
@@ -14,70 +111,450 @@ class Connection(object):
                  private_key = None,
                  password = None,
                  port = 22,
+                 max_channels = MAX_CHANNELS,
+                 timeout = None,
+                 lazy = False,
+                 control_path = None,
+                 control_persist = CONTROL_PERSIST,
+                 metrics = None,
                  ):
         self._sftp_live = False
+        self._tranport_live = False
+        self._transport = None
+        self._control = None
+        self._closed = False
+        self._keepalive = 0
         self._sftp = None
+        self._sftp_lock = threading.Lock()
+        self._connect_lock = threading.Lock()
+        # Commands may run in several threads at once, each on a
+        # channel of its own, up to the server's limit.
+        self._channels = threading.BoundedSemaphore(max_channels)
+        self.max_channels = max_channels
         if not username:
             username = os.environ['LOGNAME']
+        if not password and not private_key:
+            # Try to use default key.
+            if os.path.exists(os.path.expanduser('~/.ssh/id_rsa')):
+                private_key = '~/.ssh/id_rsa'
+            elif os.path.exists(os.path.expanduser('~/.ssh/id_dsa')):
+                private_key = '~/.ssh/id_dsa'
+            else:
+                raise TypeError, "You have not specified a password or key."
+        self.host = host
+        self.port = port
+        self.username = username
+        self.timeout = timeout
+        self.control_path = control_path
+        self.control_persist = control_persist
+        self._password = password
+        self._private_key = private_key
+        self.metrics = metrics
+        self.timings = {}
 
         # Log to a temporary file.
-        templog = tempfile.mkstemp('.txt', 'ssh-')[1]
-        paramiko.util.log_to_file(templog)
-
-        # Begin the SSH transport.
-        self._transport = paramiko.Transport((host, port))
-        self._tranport_live = True
-        # Authenticate the transport.
-        if password:
-            # Using Password.
-            self._transport.connect(username = username, password = password)
-        else:
-            # Use Private Key.
-            if not private_key:
-                # Try to use default key.
-                if os.path.exists(os.path.expanduser('~/.ssh/id_rsa')):
-                    private_key = '~/.ssh/id_rsa'
-                elif os.path.exists(os.path.expanduser('~/.ssh/id_dsa')):
-                    private_key = '~/.ssh/id_dsa'
+        _start_logging()
+        if not lazy:
+            self._connect()
+
+    def _connect(self):
+        """Connects and logs in, if that has not been done already."""
+        with self._connect_lock:
+            if self._closed:
+                raise paramiko.SSHException("The connection is closed.")
+            if self._transport or self._control:
+                return
+            started = time.time()
+            # One at the control path for someone else is left alone.
+            if self.control_path and (
+                    _control_ping(self.control_path,
+                                  self._control_identity()) or
+                    (not _control_ping(self.control_path) and
+                     self._start_control_master())):
+                self._control = self.control_path
+                self.timings = {'connect': time.time() - started,
+                                'auth': 0.0}
+                self._record('connect', started, detail = self._control)
+                return
+
+            # Begin the SSH transport.
+            deadline = self.timeout and started + self.timeout
+            transport = paramiko.Transport(socket.create_connection(
+                    (self.host, self.port), self.timeout))
+            self._transport = transport
+            self._tranport_live = True
+            try:
+                transport.start_client(timeout = _remaining(deadline))
+                self.timings = {'connect': time.time() - started}
+                self._record('connect', started)
+                # Authenticate the transport.
+                if deadline:
+                    transport.auth_timeout = _remaining(deadline)
+                started = time.time()
+                if self._password:
+                    # Using Password.
+                    transport.auth_password(self.username, self._password)
                 else:
-                    raise TypeError, "You have not specified a password or key."
+                    # Use Private Key.
+                    transport.auth_publickey(self.username,
+                                             _load_key(self._private_key))
+                self.timings['auth'] = time.time() - started
+                self._record('auth', started, detail = self.username)
+            except:
+                # Leave it to be tried again, if it was made lazily.
+                transport.close()
+                self._transport = None
+                self._tranport_live = False
+                raise
+            if self._keepalive:
+                transport.set_keepalive(self._keepalive)
+
+    def _start_control_master(self):
+        """Starts a ControlMaster at the control path in the background,
+        returning True once it is listening."""
+        options = {'host': self.host,
+                   'username': self.username,
+                   'private_key': self._private_key,
+                   'password': self._password,
+                   'port': self.port,
+                   'max_channels': self.max_channels,
+                   'timeout': self.timeout,
+                   'control_path': self.control_path,
+                   'control_persist': self.control_persist}
+        module = os.path.abspath(__file__)
+        daemon = subprocess.Popen(
+            [sys.executable, '-c', _CONTROL_COMMAND % {
+                    'directory': os.path.dirname(module),
+                    'module': os.path.splitext(os.path.basename(module))[0]}],
+            stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+            close_fds = True)
+        # Its stdout is closed once it is listening, or has given up.
+        daemon.communicate(json.dumps(options))
+        # If it could not start, another may have beaten it to it.
+        return _control_ping(self.control_path, self._control_identity())
 
-            private_key_file = os.path.expanduser(private_key)
-            rsa_key = paramiko.RSAKey.from_private_key_file(private_key_file)
-            self._transport.connect(username = username, pkey = rsa_key)
+    def _control_identity(self):
+        """Returns who a ControlMaster for this connection is logged in
+        as, and where, as user@host:port."""
+        return '%s@%s:%s' % (self.username, self.host, self.port)
+
+    def _open_session(self):
+        """Opens a channel to run a command on."""
+        self._connect()
+        if self._control:
+            return _ControlChannel(self._control, self._control_identity())
+        return self._transport.open_session()
+
+    def _open_sftp(self):
+        """Opens a new SFTP session."""
+        self._connect()
+        started = time.time()
+        if self._control:
+            sftp = paramiko.SFTPClient(_control_socket(
+                    self._control, self._control_identity(), 's'))
+        else:
+            sftp = paramiko.SFTPClient.from_transport(self._transport)
+        self._record('sftp', started)
+        return sftp
+
+    def _record(self, operation, started, size = 0, detail = ''):
+        """Gives the metrics the time taken since started, if there are
+        any metrics to give it to."""
+        if self.metrics:
+            self.metrics(self.host, operation, time.time() - started,
+                         size, detail)
+
+    def set_keepalive(self, interval):
+        """Has the connection send a keepalive every interval seconds,
+        so that one that has died is noticed. A ControlMaster sees to
+        this itself."""
+        self._keepalive = interval
+        if self._transport:
+            self._transport.set_keepalive(interval)
     
     def _sftp_connect(self):
         """Establish the SFTP connection."""
-        if not self._sftp_live:
-            self._sftp = paramiko.SFTPClient.from_transport(self._transport)
-            self._sftp_live = True
+        with self._sftp_lock:
+            if not self._sftp_live:
+                self._sftp = self._open_sftp()
+                self._sftp_live = True
 
     def get(self, remotepath, localpath = None):
         """Copies a file between the remote host and the local host."""
         if not localpath:
             localpath = os.path.split(remotepath)[1]
-        self._sftp_connect()
-        self._sftp.get(remotepath, localpath)
+        self.get_many([(remotepath, localpath)])
 
     def put(self, localpath, remotepath = None):
         """Copies a file between the local host and the remote host."""
         if not remotepath:
             remotepath = os.path.split(localpath)[1]
+        self.put_many([(localpath, remotepath)])
+
+    def get_many(self, paths, channels = SFTP_CHANNELS, checksum = None):
+        """Copies files from the remote host, returning the number of
+        bytes copied. The paths are remote paths, which are copied to
+        the current directory, or (remotepath, localpath) pairs.
+
+        Files are copied over several SFTP sessions at once, large ones
+        a range at a time, with the reads in each range pipelined.
+        If checksum names a hash such as 'md5' or 'sha256', each copy is
+        checked against the original with the remote host's md5sum or
+        sha256sum command, and IOError is raised if any differ."""
+        pairs = [_pair(path) for path in paths]
+        tasks = []
+        started = time.time()
+        with self._sftp_sessions(channels) as map_sessions:
+            sizes = map_sessions(_remote_size, [(remotepath,)
+                                                for remotepath, localpath
+                                                in pairs])
+            for (remotepath, localpath), size in zip(pairs, sizes):
+                tasks.extend(_ranges(remotepath, localpath, size))
+                if size > RANGE_SIZE:
+                    # Make it the right size for the ranges to go into.
+                    with open(localpath, 'wb') as local_file:
+                        local_file.truncate(size)
+            map_sessions(_get_range, tasks)
+        self._record('get', started, sum(sizes), _transfer_detail(pairs))
+        if checksum:
+            self._verify(checksum, [(remotepath, localpath)
+                                    for remotepath, localpath in pairs])
+        return sum(sizes)
+
+    def put_many(self, paths, channels = SFTP_CHANNELS, checksum = None):
+        """Copies files to the remote host, returning the number of bytes
+        copied. The paths are local paths, which are copied to the
+        remote home directory, or (localpath, remotepath) pairs.
+        The copying and checking is done as for get_many()."""
+        pairs = [_pair(path) for path in paths]
+        tasks = []
+        total = 0
+        started = time.time()
+        with self._sftp_sessions(channels) as map_sessions:
+            for localpath, remotepath in pairs:
+                size = os.path.getsize(localpath)
+                total += size
+                tasks.extend(_ranges(localpath, remotepath, size))
+            # Create the large files before their ranges go into them.
+            map_sessions(_create_remote, [(task[1],) for task in tasks
+                                          if task[2] == 0 and not task[4]])
+            map_sessions(_put_range, tasks)
+        self._record('put', started, total, _transfer_detail(pairs))
+        if checksum:
+            self._verify(checksum, [(remotepath, localpath)
+                                    for localpath, remotepath in pairs])
+        return total
+
+    def get_directory(self, remotepath, localpath = None,
+                      channels = SFTP_CHANNELS, checksum = None):
+        """Copies a remote directory and everything in it to the local
+        host, returning the number of bytes copied."""
+        if not localpath:
+            localpath = os.path.split(remotepath.rstrip('/'))[1]
         self._sftp_connect()
-        self._sftp.put(localpath, remotepath)
-
-    def execute(self, command):
-        """Execute the given commands on a remote machine."""
-        channel = self._transport.open_session()
-        channel.exec_command(command)
-        output = channel.makefile('rb', -1).readlines()
-        if output:
-            return output
+        pairs = []
+        directories = [(remotepath, localpath)]
+        while directories:
+            remote_directory, local_directory = directories.pop()
+            if not os.path.isdir(local_directory):
+                os.makedirs(local_directory)
+            for attributes in self._sftp.listdir_attr(remote_directory):
+                pair = (remote_directory + '/' + attributes.filename,
+                        os.path.join(local_directory, attributes.filename))
+                if stat.S_ISDIR(attributes.st_mode):
+                    directories.append(pair)
+                elif stat.S_ISREG(attributes.st_mode):
+                    pairs.append(pair)
+        return self.get_many(pairs, channels, checksum)
+
+    def put_directory(self, localpath, remotepath = None,
+                      channels = SFTP_CHANNELS, checksum = None):
+        """Copies a local directory and everything in it to the remote
+        host, returning the number of bytes copied."""
+        if not remotepath:
+            remotepath = os.path.split(localpath.rstrip(os.sep))[1]
+        self._sftp_connect()
+        pairs = []
+        for directory, subdirectories, filenames in os.walk(localpath):
+            relative = os.path.relpath(directory, localpath)
+            remote_directory = remotepath
+            if relative != os.curdir:
+                remote_directory += '/' + relative.replace(os.sep, '/')
+            try:
+                self._sftp.mkdir(remote_directory)
+            except IOError:
+                # It is there already.
+                pass
+            for filename in filenames:
+                pairs.append((os.path.join(directory, filename),
+                              remote_directory + '/' + filename))
+        return self.put_many(pairs, channels, checksum)
+
+    @contextmanager
+    def _sftp_sessions(self, channels):
+        """Yields a function that maps function(sftp, *item) over a list
+        of items, over up to channels SFTP sessions at once. An SFTP
+        session only waits for one answer at a time, so this is how
+        requests are kept in flight. The sessions are closed after."""
+        self._sftp_connect()
+        sessions = Queue.Queue()
+        sessions.put(self._sftp)
+        opened = []
+
+        def run(function, item):
+            """Does one item with an SFTP session that is not in use."""
+            try:
+                sftp = sessions.get_nowait()
+            except Queue.Empty:
+                # Each thread needs one session at most. If no more
+                # channels can be opened, wait for another thread's
+                # session, as the slots only come back at the end.
+                if not self._channels.acquire(False):
+                    sftp = sessions.get()
+                else:
+                    try:
+                        sftp = self._open_sftp()
+                    except:
+                        self._channels.release()
+                        raise
+                    opened.append(sftp)
+            try:
+                return function(sftp, *item)
+            finally:
+                sessions.put(sftp)
+
+        def map_sessions(function, items):
+            """Maps the function over the items, returning the results."""
+            return _map_threads(lambda item: run(function, item), items,
+                                channels)
+
+        try:
+            yield map_sessions
+        finally:
+            for sftp in opened:
+                sftp.close()
+                self._channels.release()
+
+    def _verify(self, algorithm, pairs):
+        """Checks that each remote and local file has the same hash,
+        raising IOError if not."""
+        command = '%ssum' % algorithm
+        # Keep the command lines short.
+        for start in range(0, len(pairs), 100):
+            batch = pairs[start:start + 100]
+            output = self.execute('%s -- %s' % (command, ' '.join(
+                pipes.quote(remotepath) for remotepath, localpath in batch)))
+            digests = [line.split()[0].lstrip('\\') for line in output]
+            if len(digests) != len(batch):
+                raise IOError("%s failed: %s" % (command, ''.join(output)))
+            for (remotepath, localpath), digest in zip(batch, digests):
+                if _file_digest(localpath, algorithm) != digest:
+                    raise IOError("%s and %s differ." % (remotepath,
+                                                         localpath))
+
+    def execute(self, command, timeout = None, deadline = None):
+        """Execute the given commands on a remote machine. If a timeout
+        is given, socket.timeout is raised when the command has not
+        sent anything for that many seconds, and if a deadline is given,
+        as a time.time(), when it has not finished by then."""
+        output = {'stdout': [], 'stderr': []}
+        for name, data in self.execute_stream(command, timeout = timeout,
+                                              deadline = deadline):
+            output[name].append(data)
+        lines = StringIO(''.join(output['stdout'])).readlines()
+        if lines:
+            return lines
         else:
-            return channel.makefile_stderr('rb', -1).readlines()
+            return StringIO(''.join(output['stderr'])).readlines()
+
+    def execute_stream(self, command, line_callback = None, timeout = None,
+                       chunk_size = STREAM_CHUNK, stdin = None,
+                       deadline = None):
+        """Execute a command on a remote machine, returning a
+        CommandStream to iterate over its output as it arrives."""
+        return CommandStream(self, command, line_callback, timeout,
+                             chunk_size, stdin, deadline)
+
+    def sync(self, localpath, remotepath = None, block_size = None):
+        """Makes the remote file the same as the local one, sending only
+        the parts that differ, as rsync does. Returns the number of
+        bytes of the file that had to be sent.
+
+        The remote host needs Python. It sends the checksums of each
+        block of its copy, then rebuilds the file from those blocks and
+        the new data sent to it, replacing it when it is complete.
+        Blocks are found wherever they have moved to, with a rolling
+        checksum, which is a lot quicker with numpy.
+        IOError is raised if the new file does not match."""
+        if not remotepath:
+            remotepath = os.path.split(localpath)[1]
+        size = os.path.getsize(localpath)
+        block_size = block_size or _sync_block_size(size)
+        output = self._run_sync_helper('signatures', remotepath, block_size)
+        signatures = []
+        for line in StringIO(output).readlines():
+            weak, strong, length = line.split()
+            signatures.append((int(weak, 16), strong, int(length)))
+
+        sent = [0]
+        with open(localpath, 'rb') as local_file:
+            if size:
+                data = mmap.mmap(local_file.fileno(), 0,
+                                 access = mmap.ACCESS_READ)
+            else:
+                data = ''
+            def delta():
+                """The delta records, counting the new data in them."""
+                for record in _sync_delta(data, signatures, block_size):
+                    if record[0] == 'D':
+                        sent[0] += len(record) - 5
+                    yield record
+            try:
+                digest = self._run_sync_helper('patch', remotepath,
+                                               block_size, delta())
+            finally:
+                if size:
+                    data.close()
+        if digest.strip() != _file_digest(localpath, 'md5'):
+            raise IOError("%s was not rebuilt correctly." % remotepath)
+        return sent[0]
+
+    def _run_sync_helper(self, mode, remotepath, block_size, stdin = None):
+        """Runs the sync helper on the remote host, returning its output
+        and raising IOError if it fails."""
+        output = {'stdout': [], 'stderr': []}
+        stream = self.execute_stream(_SYNC_COMMAND % (
+                pipes.quote(_SYNC_HELPER), mode, pipes.quote(remotepath),
+                block_size), stdin = stdin)
+        for name, data in stream:
+            output[name].append(data)
+        if stream.exit_status:
+            raise IOError("Cannot sync %s: %s" % (remotepath,
+                                                  ''.join(output['stderr'])))
+        return ''.join(output['stdout'])
+
+    def execute_many(self, commands, channels = None):
+        """Execute several commands at once, each on its own channel of
+        this connection, returning a list of their outputs in order.
+        At most channels commands run at a time, which defaults to
+        the max_channels the connection was made with."""
+        return _map_threads(self.execute, commands,
+                            channels or self.max_channels)
+
+    def is_alive(self):
+        """Returns True if the connection is still open,
+        or has not been made yet."""
+        if self._closed:
+            return False
+        if self._control:
+            return _control_ping(self._control, self._control_identity())
+        if self._transport:
+            return self._tranport_live and self._transport.is_active()
+        return True
 
     def close(self):
         """Closes the connection and cleans up."""
+        self._closed = True
         # Close SFTP Connection.
         if self._sftp_live:
             self._sftp.close()
@@ -91,6 +568,1106 @@ class Connection(object):
         """Attempt to clean up if not explicitly closed."""
         self.close()
 
+class CommandStream(object):
+    """The output of a command run by Connection.execute_stream().
+
+    Iterating over it runs the command and gives ('stdout', data) and
+    ('stderr', data) pairs of up to chunk_size bytes as they arrive.
+    Both are read at once, so a command that fills one cannot stall
+    while the other is waited on, and nothing is kept once it has been
+    given, so output of any length takes the same memory. If given,
+    line_callback(name, line) is called with each whole line as well.
+    Once the iteration is over, exit_status holds the exit status.
+    If a timeout is given, socket.timeout is raised when the command
+    has not sent anything for that many seconds, and if a deadline is
+    given, as a time.time(), when it has not finished by then. If stdin
+    is given, as a string or an iterable of strings, it is sent to the
+    command while the output is read."""
+
+    def __init__(self, connection, command, line_callback = None,
+                 timeout = None, chunk_size = STREAM_CHUNK, stdin = None,
+                 deadline = None):
+        self.connection = connection
+        self.command = command
+        self.line_callback = line_callback
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.stdin = stdin
+        self.deadline = deadline
+        self.exit_status = None
+
+    def __iter__(self):
+        with self.connection._channels:
+            started = time.time()
+            channel = self.connection._open_session()
+            self.connection._record('channel', started)
+            errors = []
+            received = 0
+            try:
+                started = time.time()
+                channel.exec_command(self.command)
+                if self.stdin is not None:
+                    sender = threading.Thread(target = self._send,
+                                              args = (channel, errors))
+                    sender.daemon = True
+                    sender.start()
+                partial_lines = {'stdout': '', 'stderr': ''}
+                for name, data in self._read(channel):
+                    received += len(data)
+                    if self.line_callback:
+                        self._call_lines(name, data, partial_lines)
+                    yield name, data
+                if self.line_callback:
+                    for name in ('stdout', 'stderr'):
+                        if partial_lines[name]:
+                            self.line_callback(name, partial_lines[name])
+                self.exit_status = channel.recv_exit_status()
+            finally:
+                channel.close()
+            if errors:
+                raise errors[0]
+            self.connection._record('execute', started, received,
+                                    self.command)
+
+    def _send(self, channel, errors):
+        """Sends stdin to the command, then tells it there is no more."""
+        stdin = self.stdin
+        if isinstance(stdin, basestring):
+            stdin = [stdin]
+        try:
+            for data in stdin:
+                channel.sendall(data)
+            channel.shutdown_write()
+        except Exception, error:
+            errors.append(error)
+            channel.close()
+
+    def _read(self, channel):
+        """Yields output from either stream until both have ended."""
+        streams = (('stdout', channel.recv_ready, channel.recv),
+                   ('stderr', channel.recv_stderr_ready, channel.recv_stderr))
+        while True:
+            # Before looking, as anything sent before the end is here now.
+            ended = channel.eof_received or channel.closed
+            waiting = True
+            for name, ready, receive in streams:
+                if ready():
+                    data = receive(self.chunk_size)
+                    if data:
+                        waiting = False
+                        yield name, data
+            if waiting:
+                if ended:
+                    return
+                wait = _remaining(self.deadline)
+                if self.timeout is not None:
+                    wait = min(self.timeout, wait or self.timeout)
+                if not select.select([channel], [], [], wait)[0]:
+                    raise socket.timeout("timed out")
+            else:
+                _remaining(self.deadline)
+
+    def _call_lines(self, name, data, partial_lines):
+        """Calls the line callback with each line that is now complete."""
+        lines = (partial_lines[name] + data).split('\n')
+        partial_lines[name] = lines.pop()
+        for line in lines:
+            self.line_callback(name, line + '\n')
+
+class ConnectionPool(object):
+    """Keeps connections open to be used again, one for each host, port
+    and username, so that many short commands do not each pay for a
+    handshake and a login.
+
+    A connection can be used by several threads at once, each command
+    getting a channel of its own on the one transport. At most
+    max_connections are kept open; when another is needed the least
+    recently used idle one is closed, or if none are idle, it waits.
+    Pooled connections send keepalives every check_interval seconds,
+    so a dead one is noticed and replaced when it is next asked for.
+    Other keyword arguments, such as password or private_key,
+    are passed on to each Connection."""
+
+    def __init__(self,
+                 max_connections = MAX_CONNECTIONS,
+                 check_interval = CHECK_INTERVAL,
+                 **defaults):
+        self.max_connections = max_connections
+        self.check_interval = check_interval
+        self.defaults = defaults
+        # Each key maps to [connection, users, last used]. The
+        # connection is None while it is being made.
+        self._pool = {}
+        self._condition = threading.Condition()
+
+    def acquire(self, host, username = None, port = None, **kwargs):
+        """Returns an open connection to the host,
+        which must be given back with release().
+        A username or port given here wins over the pool's."""
+        options = dict(self.defaults, **kwargs)
+        pool_username = options.pop('username', None)
+        pool_port = options.pop('port', None)
+        username = username or pool_username or os.environ['LOGNAME']
+        port = port or pool_port or 22
+        key = (host, port, username)
+        with self._condition:
+            while True:
+                pooled = self._pool.get(key)
+                if pooled is None:
+                    if len(self._pool) < self.max_connections or \
+                            self._evict():
+                        pooled = self._pool[key] = [None, 1, time.time()]
+                        break
+                elif pooled[0] is None:
+                    pass
+                elif pooled[0].is_alive():
+                    pooled[1] += 1
+                    return pooled[0]
+                elif pooled[1] == 0:
+                    # It has died while idle, so make a new one.
+                    del self._pool[key]
+                    continue
+                self._condition.wait()
+
+        # Connect without holding up the rest of the pool.
+        try:
+            connection = Connection(host, username, port = port, **options)
+            connection.set_keepalive(self.check_interval)
+        except:
+            with self._condition:
+                del self._pool[key]
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            pooled[0] = connection
+            self._condition.notify_all()
+        return connection
+
+    def release(self, connection):
+        """Gives back a connection from acquire()."""
+        key = (connection.host, connection.port, connection.username)
+        with self._condition:
+            pooled = self._pool.get(key)
+            if pooled and pooled[0] is connection:
+                pooled[1] -= 1
+                pooled[2] = time.time()
+            self._condition.notify_all()
+
+    @contextmanager
+    def connection(self, host, username = None, port = None, **kwargs):
+        """Use a pooled connection in a with statement."""
+        connection = self.acquire(host, username, port, **kwargs)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def execute(self, host, command, **kwargs):
+        """Execute a command on the host over a pooled connection."""
+        with self.connection(host, **kwargs) as connection:
+            return connection.execute(command)
+
+    def execute_many(self, host, commands, **kwargs):
+        """Execute several commands at once on the host, over channels
+        of one pooled connection, returning their outputs in order."""
+        with self.connection(host, **kwargs) as connection:
+            return connection.execute_many(commands)
+
+    def get_many(self, host, paths, channels = SFTP_CHANNELS,
+                 checksum = None, **kwargs):
+        """Copies files from the host over a pooled connection,
+        as Connection.get_many() does."""
+        with self.connection(host, **kwargs) as connection:
+            return connection.get_many(paths, channels, checksum)
+
+    def put_many(self, host, paths, channels = SFTP_CHANNELS,
+                 checksum = None, **kwargs):
+        """Copies files to the host over a pooled connection,
+        as Connection.put_many() does."""
+        with self.connection(host, **kwargs) as connection:
+            return connection.put_many(paths, channels, checksum)
+
+    def close(self):
+        """Closes every connection in the pool."""
+        with self._condition:
+            for connection, users, last_used in self._pool.values():
+                if connection:
+                    connection.close()
+            self._pool.clear()
+            self._condition.notify_all()
+
+    def __len__(self):
+        """The number of connections open or being opened."""
+        return len(self._pool)
+
+    def _evict(self):
+        """Closes the least recently used idle connection,
+        returning False if none are idle."""
+        idle = [(last_used, key)
+                for key, (connection, users, last_used) in self._pool.items()
+                if connection and not users]
+        if not idle:
+            return False
+        last_used, key = min(idle)
+        self._pool.pop(key)[0].close()
+        return True
+
+class Metrics(object):
+    """Collects the timings of operations, given to Connections as
+    their metrics, or to a ConnectionPool or run_many to pass on to
+    theirs. It takes a lock and appends to a list for each operation,
+    so it is cheap enough to leave on.
+
+    For each kind of operation it counts how many there were, their
+    seconds and bytes, and keeps the seconds of the last samples to
+    work out percentiles from. Any that took slow_seconds or more are
+    kept in slow, the last samples of them, as (time, host, operation,
+    seconds, size, detail) tuples, and written to log if it is given,
+    a line each."""
+
+    def __init__(self, slow_seconds = SLOW_SECONDS, log = None,
+                 samples = METRIC_SAMPLES):
+        self.slow_seconds = slow_seconds
+        self.log = log
+        self.samples = samples
+        self.slow = deque(maxlen = samples)
+        # Each operation maps to [count, seconds, bytes, last seconds].
+        self._operations = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, host, operation, seconds, size, detail):
+        with self._lock:
+            totals = self._operations.get(operation)
+            if totals is None:
+                totals = self._operations[operation] = [
+                    0, 0.0, 0, deque(maxlen = self.samples)]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += size
+            totals[3].append(seconds)
+            if seconds >= self.slow_seconds:
+                self.slow.append((time.time(), host, operation, seconds,
+                                  size, detail))
+                if self.log:
+                    self.log.write('%s %s %s %.3fs %d bytes %s\n' % (
+                            time.strftime('%Y-%m-%dT%H:%M:%S'), host,
+                            operation, seconds, size, detail[:200]))
+
+    def percentile(self, operation, percent):
+        """Returns the seconds that percent of the recent operations
+        of that kind took no longer than, or None if there were none."""
+        with self._lock:
+            totals = self._operations.get(operation)
+            if not totals:
+                return None
+            seconds = sorted(totals[3])
+        return _nearest_rank(seconds, percent)
+
+    def summary(self):
+        """Returns a dictionary of each operation's count, seconds, bytes
+        and the 50th, 90th and 99th percentiles and most of its seconds."""
+        with self._lock:
+            operations = [(operation, totals[:3], sorted(totals[3]))
+                          for operation, totals
+                          in self._operations.items()]
+        summary = {}
+        for operation, (count, seconds, size), recent in operations:
+            summary[operation] = {'count': count,
+                                  'seconds': seconds,
+                                  'bytes': size,
+                                  'max': recent[-1]}
+            for percent in (50, 90, 99):
+                summary[operation]['p%d' % percent] = _nearest_rank(
+                    recent, percent)
+        return summary
+
+    def report(self):
+        """Returns the summary as a table, slowest operations first."""
+        row = '%-10s %8s %10s %12s %10s %8s %8s %8s %8s\n'
+        report = [row % ('operation', 'count', 'seconds', 'bytes', 'MB/s',
+                         'p50', 'p90', 'p99', 'max')]
+        summary = self.summary()
+        for operation in sorted(summary, key = lambda operation:
+                                -summary[operation]['seconds']):
+            figures = summary[operation]
+            throughput = ''
+            if figures['bytes'] and figures['seconds']:
+                throughput = '%.2f' % (figures['bytes'] / 2.0 ** 20 /
+                                       figures['seconds'])
+            report.append(row % (
+                    operation, figures['count'],
+                    '%.3f' % figures['seconds'], figures['bytes'],
+                    throughput, '%.3f' % figures['p50'],
+                    '%.3f' % figures['p90'], '%.3f' % figures['p99'],
+                    '%.3f' % figures['max']))
+        return ''.join(report)
+
+class ControlMaster(object):
+    """Shares a connection with other processes over a Unix socket at
+    path, as OpenSSH's ControlMaster does, so that Connections made
+    with the same control_path need not connect and log in themselves.
+    serve() hands out commands and SFTP sessions until the connection
+    dies or it has had no clients for persist seconds.
+
+    Each request is one frame: a letter for the kind and a 32 bit
+    length, then that much data. A client first sends 'h' with the
+    user, host and port it wants, as user@host:port, so it is not
+    given someone else's connection. Then 'p' asks if it is there, 'x'
+    runs the command in its data and 's' starts an SFTP session. It
+    answers each 'k' when it has been done, or 'f' and the error if it
+    could not. An SFTP session is then passed through as it is. A command
+    is given 'i' frames for its stdin and 'w' when that has ended, and
+    sends back 'o' and 'e' frames of its stdout and stderr, and lastly
+    'x' with its exit status."""
+
+    def __init__(self, connection, path, persist = CONTROL_PERSIST):
+        self.connection = connection
+        self.path = path
+        self.persist = persist
+        self._clients = 0
+        self._last_used = time.time()
+        self._lock = threading.Lock()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path) and not _control_ping(path):
+            # Left behind by one that has stopped.
+            os.remove(path)
+        # Only we may use it.
+        umask = os.umask(0177)
+        try:
+            self._socket.bind(path)
+        finally:
+            os.umask(umask)
+        self._socket.listen(socket.SOMAXCONN)
+        self._socket.settimeout(1)
+
+    def serve(self):
+        """Answers clients until the connection has died or nothing
+        has been asked of it for persist seconds."""
+        try:
+            while self.connection.is_alive():
+                try:
+                    client = self._socket.accept()[0]
+                except socket.timeout:
+                    with self._lock:
+                        if not self._clients and \
+                                time.time() - self._last_used > self.persist:
+                            return
+                    continue
+                client.settimeout(None)
+                with self._lock:
+                    self._clients += 1
+                thread = threading.Thread(target = self._handle,
+                                          args = (client,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops listening for clients."""
+        self._socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _handle(self, client):
+        """Answers one client."""
+        try:
+            kind, data = _read_frame(client)
+            if kind != 'h' or \
+                    data != self.connection._control_identity():
+                raise paramiko.SSHException(
+                    "The ControlMaster at %s is for %s." % (
+                        self.path, self.connection._control_identity()))
+            _send_frame(client, 'k')
+            kind, data = _read_frame(client)
+            if kind == 'p':
+                _send_frame(client, 'k')
+            elif kind == 'x':
+                self._execute(client, data)
+            elif kind == 's':
+                self._sftp(client)
+        except Exception, error:
+            try:
+                _send_frame(client, 'f', str(error))
+            except socket.error:
+                pass
+        finally:
+            # Shut down as well, for the thread reading stdin.
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            client.close()
+            with self._lock:
+                self._clients -= 1
+                self._last_used = time.time()
+
+    def _execute(self, client, command):
+        """Runs a command for the client."""
+        with self.connection._channels:
+            channel = self.connection._open_session()
+            try:
+                channel.exec_command(command)
+                # Read stdin in a thread of its own, so a command
+                # waiting to send output cannot hold it up.
+                sender = threading.Thread(target = self._send,
+                                          args = (client, channel))
+                sender.daemon = True
+                sender.start()
+                streams = (('o', channel.recv_ready, channel.recv),
+                           ('e', channel.recv_stderr_ready,
+                            channel.recv_stderr))
+                while True:
+                    ended = channel.eof_received or channel.closed
+                    waiting = True
+                    for kind, ready, receive in streams:
+                        if ready():
+                            data = receive(STREAM_CHUNK)
+                            if data:
+                                waiting = False
+                                _send_frame(client, kind, data)
+                    if waiting:
+                        if ended:
+                            break
+                        select.select([channel], [], [])
+                _send_frame(client, 'x', struct.pack(
+                        '!i', channel.recv_exit_status()))
+            finally:
+                channel.close()
+
+    def _send(self, client, channel):
+        """Passes stdin from the client on to the command."""
+        try:
+            while True:
+                kind, data = _read_frame(client)
+                if kind == 'i':
+                    channel.sendall(data)
+                elif kind == 'w':
+                    channel.shutdown_write()
+                else:
+                    # The client has gone.
+                    break
+        except (socket.error, paramiko.SSHException):
+            pass
+        channel.close()
+
+    def _sftp(self, client):
+        """Passes an SFTP session through to the client."""
+        with self.connection._channels:
+            channel = self.connection._open_session()
+            try:
+                channel.invoke_subsystem('sftp')
+                _send_frame(client, 'k')
+                # A thread for each way, so neither waits on the other.
+                upload = threading.Thread(target = _splice,
+                                          args = (client.recv, channel))
+                upload.daemon = True
+                upload.start()
+                _splice(channel.recv, client)
+                upload.join()
+            finally:
+                channel.close()
+
+class _ControlChannel(object):
+    """A command run through a ControlMaster, with the parts of a
+    paramiko Channel that CommandStream uses."""
+
+    def __init__(self, path, identity):
+        self._socket = _control_socket(path, identity)
+        self._received = ''
+        self._buffers = {'o': '', 'e': ''}
+        self._exit_status = -1
+        self.eof_received = False
+        self.closed = False
+
+    def exec_command(self, command):
+        """Starts the command."""
+        _send_frame(self._socket, 'x', command)
+
+    def fileno(self):
+        """For select()."""
+        return self._socket.fileno()
+
+    def recv_ready(self):
+        self._fill()
+        return bool(self._buffers['o'])
+
+    def recv_stderr_ready(self):
+        self._fill()
+        return bool(self._buffers['e'])
+
+    def recv(self, size):
+        return self._take('o', size)
+
+    def recv_stderr(self, size):
+        return self._take('e', size)
+
+    def recv_exit_status(self):
+        while not self.eof_received:
+            select.select([self._socket], [], [])
+            self._fill()
+        return self._exit_status
+
+    def sendall(self, data):
+        _send_frame(self._socket, 'i', data)
+
+    def shutdown_write(self):
+        _send_frame(self._socket, 'w')
+
+    def close(self):
+        self.closed = True
+        self._socket.close()
+
+    def _take(self, kind, size):
+        """Returns up to size bytes of the output."""
+        data = self._buffers[kind][:size]
+        self._buffers[kind] = self._buffers[kind][size:]
+        return data
+
+    def _fill(self):
+        """Sorts out whatever the ControlMaster has sent,
+        without waiting for more."""
+        while not self.eof_received and \
+                select.select([self._socket], [], [], 0)[0]:
+            data = self._socket.recv(STREAM_CHUNK + 5)
+            if not data:
+                self.eof_received = True
+                break
+            self._received += data
+            while len(self._received) >= 5:
+                kind, length = struct.unpack('!cI', self._received[:5])
+                if len(self._received) < length + 5:
+                    break
+                data = self._received[5:length + 5]
+                self._received = self._received[length + 5:]
+                if kind in self._buffers:
+                    self._buffers[kind] += data
+                elif kind == 'x':
+                    self._exit_status = struct.unpack('!i', data)[0]
+                    self.eof_received = True
+                elif kind == 'f':
+                    raise paramiko.SSHException(data)
+
+class _ControlSocket(socket.socket):
+    """A socket to a ControlMaster, which paramiko can run SFTP over."""
+
+    def get_name(self):
+        """What paramiko logs the SFTP session as."""
+        return 'control'
+
+def _map_threads(function, items, threads):
+    """Calls function on each item in up to threads threads at once,
+    returning a list of the results in order. If any call raises an
+    exception, no more are started and the first is raised again."""
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    work = Queue.Queue()
+    for position, item in enumerate(items):
+        work.put((position, item))
+
+    def worker():
+        """Call the function on items from the queue until it is empty."""
+        while not errors:
+            try:
+                position, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[position] = function(item)
+            except Exception, error:
+                errors.append(error)
+
+    workers = [threading.Thread(target = worker)
+               for i in range(min(threads, len(items)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+def _pair(path):
+    """Turns a path into a (source, destination) pair, with the
+    destination being the file's name if it is not given."""
+    if isinstance(path, basestring):
+        return path, os.path.split(path)[1]
+    return path
+
+def _nearest_rank(values, percent):
+    """Returns the percentile of the sorted values."""
+    rank = int(math.ceil(len(values) * percent / 100.0))
+    return values[max(rank - 1, 0)]
+
+def _transfer_detail(pairs):
+    """Describes the files being copied, for metrics."""
+    if len(pairs) == 1:
+        return pairs[0][0]
+    return '%d files' % len(pairs)
+
+def _ranges(source, destination, size):
+    """Returns the tasks for copying a file, splitting a large one into
+    ranges. A task of a whole file creates the destination."""
+    if size <= RANGE_SIZE:
+        return [(source, destination, 0, size, True)]
+    return [(source, destination, offset, min(RANGE_SIZE, size - offset),
+             False)
+            for offset in xrange(0, size, RANGE_SIZE)]
+
+def _remote_size(sftp, remotepath):
+    """Returns the size of a remote file."""
+    return sftp.stat(remotepath).st_size
+
+def _create_remote(sftp, remotepath):
+    """Creates an empty remote file, or empties one."""
+    sftp.open(remotepath, 'wb').close()
+
+def _get_range(sftp, remotepath, localpath, offset, length, whole):
+    """Copies part of a remote file into a local one, asking for every
+    chunk of it before waiting for the first."""
+    remote_file = sftp.open(remotepath, 'rb')
+    try:
+        with open(localpath, 'wb' if whole else 'r+b') as local_file:
+            local_file.seek(offset)
+            chunks = [(position, min(SFTP_CHUNK, offset + length - position))
+                      for position in xrange(offset, offset + length,
+                                             SFTP_CHUNK)]
+            if chunks:
+                for data in remote_file.readv(chunks):
+                    local_file.write(data)
+    finally:
+        remote_file.close()
+
+def _put_range(sftp, localpath, remotepath, offset, length, whole):
+    """Copies part of a local file into a remote one, sending every
+    write before waiting for the answers."""
+    remote_file = sftp.open(remotepath, 'wb' if whole else 'r+b')
+    try:
+        remote_file.set_pipelined(True)
+        remote_file.seek(offset)
+        with open(localpath, 'rb') as local_file:
+            local_file.seek(offset)
+            while length > 0:
+                data = local_file.read(min(length, 2 ** 20))
+                if not data:
+                    break
+                remote_file.write(data)
+                length -= len(data)
+    finally:
+        # This waits for the answers to the writes.
+        remote_file.close()
+
+def _file_digest(filename, algorithm):
+    """Returns the hex digest of a local file."""
+    digest = hashlib.new(algorithm)
+    with open(filename, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(2 ** 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# The other end of Connection.sync(), run by the remote host's Python
+# 2 or 3. "signatures PATH SIZE" writes the Adler-32 and MD5 of each
+# block of the file. "patch PATH SIZE" rebuilds the file from a delta
+# on stdin, then writes the MD5 of the new file.
+_SYNC_HELPER = r'''
+import os, sys, zlib, struct, hashlib
+mode, path, size = sys.argv[1], sys.argv[2], int(sys.argv[3])
+if mode == 'signatures':
+    if not os.path.isfile(path):
+        sys.exit(0)
+    old = open(path, 'rb')
+    while True:
+        block = old.read(size)
+        if not block:
+            break
+        sys.stdout.write('%08x %s %d\n' % (zlib.adler32(block) & 0xffffffff,
+                                           hashlib.md5(block).hexdigest(),
+                                           len(block)))
+    sys.exit(0)
+delta = getattr(sys.stdin, 'buffer', sys.stdin)
+old = None
+if os.path.isfile(path):
+    old = open(path, 'rb')
+temporary = '%s.sync-%d' % (path, os.getpid())
+new = open(temporary, 'wb')
+digest = hashlib.md5()
+try:
+    while True:
+        kind = delta.read(1)
+        if not kind:
+            break
+        if kind == b'C':
+            offset, length = struct.unpack('!QQ', delta.read(16))
+            old.seek(offset)
+        else:
+            length = struct.unpack('!I', delta.read(4))[0]
+        source = kind == b'C' and old or delta
+        while length:
+            data = source.read(min(length, 1048576))
+            if not data:
+                raise IOError('The delta or the old file is too short.')
+            new.write(data)
+            digest.update(data)
+            length -= len(data)
+    new.close()
+    if old:
+        os.chmod(temporary, os.stat(path).st_mode & 4095)
+    os.rename(temporary, path)
+except:
+    os.remove(temporary)
+    raise
+sys.stdout.write(digest.hexdigest() + '\n')
+'''
+
+# Run the helper with whichever Python the remote host has.
+_SYNC_COMMAND = ('PYTHON=$(command -v python3 || command -v python) && '
+                 '"$PYTHON" -c %s %s %s %d')
+
+# The local file is rolled over this many bytes at a time.
+_SYNC_SEGMENT = 2 ** 22
+
+# Adler-32 sums are taken modulo this.
+_ADLER = 65521
+
+def _sync_block_size(size):
+    """Picks a block size near the square root of the file size,
+    as rsync does, as a power of two from 2 KB to 128 KB."""
+    block_size = 2 ** 11
+    while block_size < 2 ** 17 and block_size * block_size < size:
+        block_size *= 2
+    return block_size
+
+def _sync_delta(data, signatures, block_size):
+    """Yields the records that turn the remote file with the given
+    signatures into data: 'C' with an offset and length to copy from
+    the remote file, or 'D' with a length and literal data."""
+    blocks = {}
+    tail = None
+    for offset, (weak, strong, length) in enumerate(signatures):
+        if length == block_size:
+            blocks.setdefault(weak, {}).setdefault(strong,
+                                                   offset * block_size)
+        else:
+            tail = (strong, offset * block_size, length)
+    copy = [None, 0]
+    literal = [0]
+
+    def lookup(position):
+        """Returns the remote offset of the block at position, or None."""
+        block = data[position:position + block_size]
+        strongs = blocks.get(zlib.adler32(block) & 0xffffffff)
+        if strongs:
+            return strongs.get(hashlib.md5(block).hexdigest())
+
+    def matches():
+        """Yields the (position, remote offset) of each block to copy,
+        from the start of data to the end."""
+        if not blocks:
+            return
+        last = len(data) - block_size
+        position = 0
+        candidates = []
+        while position <= last:
+            # Most blocks follow on from the last, so try there first.
+            offset = lookup(position)
+            if offset is not None:
+                yield position, offset
+                position += block_size
+                continue
+            if numpy is None:
+                position = _sync_roll(data, position, last, block_size,
+                                      blocks)
+                continue
+            if not len(candidates) or candidates[-1] <= position:
+                # Roll on to find where the next block might be.
+                candidates = _sync_candidates(data, position, block_size,
+                                              blocks)
+                end = min(position + _SYNC_SEGMENT, last + 1)
+            index = numpy.searchsorted(candidates, position, 'right')
+            for candidate in candidates[index:]:
+                offset = lookup(int(candidate))
+                if offset is not None:
+                    yield int(candidate), offset
+                    position = int(candidate) + block_size
+                    break
+            else:
+                position = end
+                candidates = []
+
+    def literal_records(end):
+        """Yields the data from where the last block ended up to end."""
+        while literal[0] < end:
+            length = min(end - literal[0], 2 ** 20)
+            yield 'D' + struct.pack('!I', length) + \
+                data[literal[0]:literal[0] + length]
+            literal[0] += length
+
+    for position, offset in matches():
+        if copy[0] is not None and literal[0] == position and \
+                copy[0] + copy[1] == offset:
+            # Carry on copying the same run of blocks.
+            copy[1] += block_size
+        else:
+            if copy[0] is not None:
+                yield 'C' + struct.pack('!QQ', copy[0], copy[1])
+            for record in literal_records(position):
+                yield record
+            copy = [offset, block_size]
+        literal[0] = position + block_size
+    if copy[0] is not None:
+        yield 'C' + struct.pack('!QQ', copy[0], copy[1])
+    end = len(data)
+    if tail and end - literal[0] >= tail[2] and \
+            hashlib.md5(data[end - tail[2]:end]).hexdigest() == tail[0]:
+        end -= tail[2]
+        for record in literal_records(end):
+            yield record
+        yield 'C' + struct.pack('!QQ', tail[1], tail[2])
+    else:
+        for record in literal_records(end):
+            yield record
+
+def _sync_candidates(data, start, block_size, blocks):
+    """Returns the positions, in up to _SYNC_SEGMENT from start, of
+    blocks whose Adler-32 might be one of the remote blocks'."""
+    weaks = _rolling_adler32(data, start, block_size)
+    # Narrow them down with a bitmap of the remote sums first.
+    bitmap = numpy.zeros(2 ** 20, bool)
+    keys = numpy.array(list(blocks), numpy.int64)
+    bitmap[(keys ^ (keys >> 12)) & 0xfffff] = True
+    positions = numpy.flatnonzero(bitmap[(weaks ^ (weaks >> 12)) & 0xfffff])
+    keys.sort()
+    found = keys[numpy.minimum(numpy.searchsorted(keys, weaks[positions]),
+                               len(keys) - 1)] == weaks[positions]
+    return positions[found] + start
+
+def _sync_roll(data, start, last, block_size, blocks):
+    """Rolls on a byte at a time from start, returning the next position,
+    in up to _SYNC_SEGMENT, of a block whose Adler-32 might be one of the
+    remote blocks', or the position after the last one looked at.
+    This is _sync_candidates() for when there is no numpy."""
+    end = min(start + _SYNC_SEGMENT, last)
+    window = bytearray(data[start:end + block_size])
+    low = (1 + sum(window[:block_size])) % _ADLER
+    high = (block_size + sum((block_size - i) * byte for i, byte
+                             in enumerate(window[:block_size]))) % _ADLER
+    for position in xrange(end - start):
+        removed = window[position]
+        low = (low - removed + window[position + block_size]) % _ADLER
+        high = (high - block_size * removed + low - 1) % _ADLER
+        if (high << 16 | low) in blocks:
+            return start + position + 1
+    return end + 1
+
+def _rolling_adler32(data, start, block_size):
+    """Returns the Adler-32 of the block at every position from start,
+    for up to _SYNC_SEGMENT positions, as zlib.adler32 would give."""
+    end = min(start + _SYNC_SEGMENT, len(data) - block_size + 1)
+    window = numpy.frombuffer(data[start:end + block_size - 1],
+                              numpy.uint8).astype(numpy.int64)
+    indices = numpy.arange(len(window), dtype = numpy.int64)
+    sums = numpy.concatenate(([0], numpy.cumsum(window)))
+    weighted = numpy.concatenate(([0], numpy.cumsum(window * indices)))
+    positions = indices[:end - start]
+    totals = sums[positions + block_size] - sums[positions]
+    # The sum of (block_size - i) * x[i] over the block.
+    moments = (block_size + positions) * totals - \
+        (weighted[positions + block_size] - weighted[positions])
+    low = (1 + totals) % _ADLER
+    high = (block_size + moments) % _ADLER
+    return (high << 16) | low
+
+def run_many(hosts, command, concurrency = CONCURRENCY, timeout = None,
+             **kwargs):
+    """Runs a command on many hosts at once, yielding a HostResult for
+    each host as it finishes, so the slowest hosts do not hold up the
+    rest. Up to concurrency hosts are connected to at a time.
+
+    The timeout is how many seconds each host has to connect,
+    authenticate and run the command in. A host that fails or takes
+    too long gives a HostResult with the exception as its error.
+    Other keyword arguments, such as username or password,
+    are passed on to each Connection."""
+    hosts = list(hosts)
+    waiting = Queue.Queue()
+    for host in hosts:
+        waiting.put(host)
+    results = Queue.Queue()
+    stop = threading.Event()
+
+    def worker():
+        """Runs the command on hosts from the queue until it is empty."""
+        while not stop.is_set():
+            try:
+                host = waiting.get_nowait()
+            except Queue.Empty:
+                return
+            results.put(_run_one(host, command, timeout, kwargs))
+
+    for i in range(min(concurrency, len(hosts))):
+        thread = threading.Thread(target = worker)
+        thread.daemon = True
+        thread.start()
+    try:
+        for i in range(len(hosts)):
+            yield results.get()
+    finally:
+        # Start no more hosts if we are not wanted any more.
+        stop.set()
+
+def _run_one(host, command, timeout, kwargs):
+    """Connects to one host and runs the command, returning a HostResult."""
+    timings = {}
+    output = error = connection = None
+    deadline = timeout and time.time() + timeout
+    try:
+        connection = Connection(host, timeout = timeout, **kwargs)
+        timings = dict(connection.timings)
+        started = time.time()
+        output = connection.execute(command, deadline = deadline)
+        timings['execute'] = time.time() - started
+    except Exception, error:
+        if connection:
+            timings = dict(connection.timings)
+    finally:
+        if connection:
+            connection.close()
+    return HostResult(host, output, error, timings.get('connect'),
+                      timings.get('auth'), timings.get('execute'))
+
+def _remaining(deadline):
+    """Returns the seconds left before the deadline, or None if there is
+    no deadline, raising socket.timeout if it has passed."""
+    if not deadline:
+        return None
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise socket.timeout("timed out")
+    return remaining
+
+def _start_logging():
+    """Has paramiko log to a temporary file, made the first time this is
+    called, unless its logging has been set up some other way."""
+    logger = logging.getLogger('paramiko')
+    with _LOGGING_LOCK:
+        if not logger.handlers:
+            handle, filename = tempfile.mkstemp('.txt', 'ssh-')
+            os.close(handle)
+            paramiko.util.log_to_file(filename, LOG_LEVEL)
+
+def _load_key(filename):
+    """Returns the private key in the file, which is only read the first
+    time it is wanted in this process, or if it has changed since."""
+    filename = os.path.abspath(os.path.expanduser(filename))
+    changed = os.stat(filename).st_mtime
+    with _KEYS_LOCK:
+        cached = _KEYS.get(filename)
+    if cached and cached[0] == changed:
+        return cached[1]
+    key = paramiko.RSAKey.from_private_key_file(filename)
+    with _KEYS_LOCK:
+        _KEYS[filename] = (changed, key)
+    return key
+
+def _control_socket(path, identity, kind = None):
+    """Connects to the ControlMaster at path, returning the socket, once
+    it has said it is logged in as identity, user@host:port, and after
+    starting a session of the given kind if one is given."""
+    control = _ControlSocket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        control.connect(path)
+        for request, data in (('h', identity), (kind, '')):
+            if not request:
+                break
+            _send_frame(control, request, data)
+            answer, data = _read_frame(control)
+            if answer != 'k':
+                raise paramiko.SSHException(
+                    data or "The ControlMaster has gone.")
+    except:
+        control.close()
+        raise
+    return control
+
+def _control_ping(path, identity = None):
+    """Returns True if a ControlMaster logged in as identity is answering
+    at path, or if the identity is None, any ControlMaster at all."""
+    try:
+        _control_socket(path, identity or '', 'p').close()
+    except paramiko.SSHException:
+        # One that is there for someone else says so.
+        return identity is None
+    except socket.error:
+        return False
+    return True
+
+def _control_daemon():
+    """Reads the options of a Connection from stdin as JSON, and serves
+    it with a ControlMaster in the background. Used by
+    Connection._start_control_master()."""
+    options = json.load(sys.stdin)
+    path = options.pop('control_path')
+    persist = options.pop('control_persist')
+    # Leave the process that started us, so it need not wait for us.
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    try:
+        connection = Connection(**options)
+        master = ControlMaster(connection, path, persist)
+    except Exception:
+        return
+    null = os.open(os.devnull, os.O_RDWR)
+    for handle in range(3):
+        os.dup2(null, handle)
+    try:
+        master.serve()
+    finally:
+        connection.close()
+
+def _send_frame(sock, kind, data = ''):
+    """Sends a ControlMaster frame."""
+    sock.sendall(struct.pack('!cI', kind, len(data)) + data)
+
+def _read_frame(sock):
+    """Returns the kind and data of the next ControlMaster frame,
+    or (None, '') if the other end has gone."""
+    header = _recv_exactly(sock, 5)
+    if len(header) < 5:
+        return None, ''
+    kind, length = struct.unpack('!cI', header)
+    data = _recv_exactly(sock, length)
+    if len(data) < length:
+        return None, ''
+    return kind, data
+
+def _recv_exactly(sock, size):
+    """Receives size bytes, or as many as come before the end."""
+    parts = []
+    while size:
+        data = sock.recv(min(size, 2 ** 20))
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+    return ''.join(parts)
+
+def _splice(receive, destination):
+    """Sends everything received on to the destination until the end."""
+    try:
+        while True:
+            data = receive(STREAM_CHUNK)
+            if not data:
+                break
+            destination.sendall(data)
+    except (socket.error, EOFError, paramiko.SSHException):
+        pass
+    try:
+        destination.shutdown(socket.SHUT_WR)
+    except (socket.error, EOFError, paramiko.SSHException):
+        pass
+
 def main():
     """Little test when called directly."""
     # Set these to your own details.
@@ -0,0 +1,704 @@
+#!/usr/bin/env python
+"""Tests for ssh.py, against a stub SSH server run in the same process.
+
+The stub server is made with paramiko. It runs commands with the local
+shell and serves SFTP from the local filesystem, so files are "remote"
+and local at once, in a temporary directory. It accepts any password
+but 'wrong', and counts the connections made to it.
+"""
+
+import os
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import unittest
+import zlib
+
+import paramiko
+
+import ssh
+
+class StubServer(object):
+    """An SSH server on a free port of localhost."""
+
+    host_key = None
+
+    def __init__(self):
+        if StubServer.host_key is None:
+            StubServer.host_key = paramiko.RSAKey.generate(1024)
+        self.connections = 0
+        # Commands wait this many seconds before they start.
+        self.exec_delay = 0
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(100)
+        self.port = self._socket.getsockname()[1]
+        self._transports = []
+        thread = threading.Thread(target = self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        """Starts a transport for each client."""
+        while True:
+            try:
+                client = self._socket.accept()[0]
+            except socket.error:
+                return
+            self.connections += 1
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                            _StubSFTP)
+            transport.start_server(server = _StubInterface(self))
+            self._transports.append(transport)
+
+    def close(self):
+        """Stops the server and drops its clients."""
+        self._socket.close()
+        for transport in self._transports:
+            transport.close()
+
+class _StubInterface(paramiko.ServerInterface):
+    """Lets anyone in, and runs their commands with the shell."""
+
+    def __init__(self, server):
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        if password == 'wrong':
+            return paramiko.AUTH_FAILED
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, channel_id):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_global_request(self, kind, message):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target = _run_command,
+                                  args = (channel, command,
+                                          self.server.exec_delay))
+        thread.daemon = True
+        thread.start()
+        return True
+
+def _run_command(channel, command, delay):
+    """Runs a command, passing its streams to and from the channel."""
+    time.sleep(delay)
+    process = subprocess.Popen(command, shell = True,
+                               stdin = subprocess.PIPE,
+                               stdout = subprocess.PIPE,
+                               stderr = subprocess.PIPE)
+
+    def pump(stream, send):
+        """Sends a stream of the command until it ends."""
+        try:
+            while True:
+                data = os.read(stream.fileno(), 32768)
+                if not data:
+                    break
+                send(data)
+        except socket.error:
+            # The client has gone.
+            pass
+
+    def feed():
+        """Passes stdin to the command until the client stops."""
+        try:
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                process.stdin.write(data)
+            process.stdin.close()
+        except (IOError, socket.error):
+            pass
+
+    feeder = threading.Thread(target = feed)
+    feeder.daemon = True
+    feeder.start()
+    pumps = [threading.Thread(target = pump,
+                              args = (process.stdout, channel.sendall)),
+             threading.Thread(target = pump,
+                              args = (process.stderr,
+                                      channel.sendall_stderr))]
+    for thread in pumps:
+        thread.daemon = True
+        thread.start()
+    for thread in pumps:
+        thread.join()
+    try:
+        channel.send_exit_status(process.wait())
+    except socket.error:
+        pass
+    channel.close()
+
+class _StubHandle(paramiko.SFTPHandle):
+    """An open file of the stub SFTP server."""
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.fstat(self.readfile.fileno()))
+        except OSError, error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def chattr(self, attributes):
+        return paramiko.SFTP_OK
+
+class _StubSFTP(paramiko.SFTPServerInterface):
+    """Serves the local filesystem."""
+
+    def list_folder(self, path):
+        try:
+            folder = []
+            for name in os.listdir(path):
+                attributes = paramiko.SFTPAttributes.from_stat(
+                    os.lstat(os.path.join(path, name)))
+                attributes.filename = name
+                folder.append(attributes)
+            return folder
+        except OSError, error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError, error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(path))
+        except OSError, error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+
+    def open(self, path, flags, attributes):
+        try:
+            handle = os.open(path, flags,
+                             getattr(attributes, 'st_mode', None) or 0666)
+        except OSError, error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        sftp_handle = _StubHandle(flags)
+        sftp_handle.filename = path
+        sftp_handle.readfile = sftp_handle.writefile = os.fdopen(handle,
+                                                                 mode)
+        return sftp_handle
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, old_path, new_path):
+        return self._call(os.rename, old_path, new_path)
+
+    def posix_rename(self, old_path, new_path):
+        return self._call(os.rename, old_path, new_path)
+
+    def mkdir(self, path, attributes):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, path)
+
+    def chattr(self, path, attributes):
+        return paramiko.SFTP_OK
+
+    def _call(self, function, *args):
+        """Calls an os function, turning an error into an SFTP one."""
+        try:
+            function(*args)
+        except OSError, error:
+            return paramiko.SFTPServer.convert_errno(error.errno)
+        return paramiko.SFTP_OK
+
+def _within(seconds, function, *args, **kwargs):
+    """Calls the function, failing instead of hanging if it has not
+    returned in that many seconds."""
+    result = []
+    errors = []
+
+    def call():
+        """Keeps the result or the error."""
+        try:
+            result.append(function(*args, **kwargs))
+        except Exception, error:
+            errors.append(error)
+
+    thread = threading.Thread(target = call)
+    thread.daemon = True
+    thread.start()
+    thread.join(seconds)
+    if thread.is_alive():
+        raise AssertionError("%s did not finish in %s seconds."
+                             % (function.__name__, seconds))
+    if errors:
+        raise errors[0]
+    return result[0]
+
+class SSHTestCase(unittest.TestCase):
+    """Starts a stub server and a temporary directory for each test."""
+
+    def setUp(self):
+        self.server = StubServer()
+        self.directory = tempfile.mkdtemp('-sshtest')
+        self.connections = []
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.close()
+        self.server.close()
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+    def connect(self, **kwargs):
+        """Returns a Connection to the stub server,
+        which is closed after the test."""
+        options = {'username': 'tester', 'password': 'secret',
+                   'port': self.server.port}
+        options.update(kwargs)
+        connection = ssh.Connection('127.0.0.1', **options)
+        self.connections.append(connection)
+        return connection
+
+    def path(self, name):
+        """Returns the name of a file in the temporary directory."""
+        return os.path.join(self.directory, name)
+
+    def write(self, name, data):
+        """Writes a file in the temporary directory,
+        returning its name."""
+        with open(self.path(name), 'wb') as new_file:
+            new_file.write(data)
+        return self.path(name)
+
+    def read(self, name):
+        """Returns what is in a file in the temporary directory."""
+        with open(self.path(name), 'rb') as old_file:
+            return old_file.read()
+
+class ExecuteTest(SSHTestCase):
+    """Running commands."""
+
+    def test_execute(self):
+        connection = self.connect()
+        self.assertEqual(connection.execute('echo one; echo two'),
+                         ['one\n', 'two\n'])
+        self.assertEqual(connection.execute('echo error >&2'),
+                         ['error\n'])
+
+    def test_execute_many(self):
+        connection = self.connect()
+        self.server.exec_delay = 0.5
+        started = time.time()
+        outputs = connection.execute_many(['echo %d' % number
+                                           for number in range(20)])
+        self.assertEqual(outputs, [['%d\n' % number]
+                                   for number in range(20)])
+        # Two rounds of ten channels, rather than twenty in turn.
+        self.assertTrue(time.time() - started < 5)
+
+class PoolTest(SSHTestCase):
+    """ConnectionPool."""
+
+    def pool(self, **kwargs):
+        """Returns a pool for the stub server,
+        which is closed after the test."""
+        pool = ssh.ConnectionPool(password = 'secret',
+                                  port = self.server.port, **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_reuse(self):
+        pool = self.pool()
+        self.assertEqual(pool.execute('127.0.0.1', 'echo 1',
+                                      username = 'a'), ['1\n'])
+        self.assertEqual(pool.execute('127.0.0.1', 'echo 2',
+                                      username = 'a'), ['2\n'])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(pool), 1)
+
+    def test_overrides(self):
+        pool = self.pool(username = 'a')
+        pool.execute('127.0.0.1', 'true')
+        pool.execute('127.0.0.1', 'true', username = 'b')
+        self.assertEqual(sorted(key[2] for key in pool._pool), ['a', 'b'])
+        other = ssh.ConnectionPool(password = 'secret', port = 1)
+        self.addCleanup(other.close)
+        self.assertEqual(other.execute('127.0.0.1', 'echo ok',
+                                       port = self.server.port,
+                                       username = 'a'), ['ok\n'])
+
+    def test_eviction(self):
+        pool = self.pool(max_connections = 2)
+        for username in ('a', 'b', 'c'):
+            pool.execute('127.0.0.1', 'true', username = username)
+        self.assertEqual(sorted(key[2] for key in pool._pool), ['b', 'c'])
+
+    def test_one_connection_for_many_threads(self):
+        pool = self.pool()
+        threads = [threading.Thread(target = pool.execute,
+                                    args = ('127.0.0.1', 'true'),
+                                    kwargs = {'username': 'a'})
+                   for number in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.server.connections, 1)
+
+    def test_dead_connection_replaced(self):
+        pool = self.pool()
+        connection = pool.acquire('127.0.0.1', 'a')
+        pool.release(connection)
+        connection._transport.close()
+        self.assertEqual(pool.execute('127.0.0.1', 'echo back',
+                                      username = 'a'), ['back\n'])
+        self.assertEqual(self.server.connections, 2)
+
+    def test_failed_login_not_kept(self):
+        pool = self.pool()
+        self.assertRaises(paramiko.AuthenticationException, pool.execute,
+                          '127.0.0.1', 'true', username = 'a',
+                          password = 'wrong')
+        self.assertEqual(len(pool), 0)
+
+class RunManyTest(SSHTestCase):
+    """run_many()."""
+
+    def test_results(self):
+        results = list(ssh.run_many(['127.0.0.1'] * 5, 'echo ok',
+                                    port = self.server.port,
+                                    username = 'a', password = 'secret'))
+        self.assertEqual([result.output for result in results],
+                         [['ok\n']] * 5)
+        self.assertTrue(all(result.connect is not None and
+                            result.execute is not None
+                            for result in results))
+
+    def test_timeout(self):
+        # Output that keeps coming does not stop the clock.
+        started = time.time()
+        results = list(ssh.run_many(
+                ['127.0.0.1'] * 3,
+                'for i in 1 2 3 4 5 6; do echo $i; sleep 1; done',
+                timeout = 2, port = self.server.port, username = 'a',
+                password = 'secret'))
+        self.assertTrue(time.time() - started < 4)
+        self.assertEqual([type(result.error) for result in results],
+                         [socket.timeout] * 3)
+
+    def test_failures(self):
+        results = list(ssh.run_many(['127.0.0.1'], 'true', timeout = 5,
+                                    port = self.server.port,
+                                    username = 'a', password = 'wrong'))
+        self.assertTrue(isinstance(results[0].error,
+                                   paramiko.AuthenticationException))
+        self.assertEqual(results[0].output, None)
+
+    def test_execute_timeouts(self):
+        connection = self.connect()
+        started = time.time()
+        self.assertRaises(socket.timeout, connection.execute, 'sleep 5',
+                          timeout = 0.5)
+        self.assertTrue(time.time() - started < 2)
+        started = time.time()
+        self.assertRaises(socket.timeout, connection.execute,
+                          'while true; do echo tick; sleep 0.2; done',
+                          timeout = 1, deadline = time.time() + 1)
+        self.assertTrue(time.time() - started < 2)
+
+    def test_timings(self):
+        connection = self.connect()
+        self.assertEqual(sorted(connection.timings), ['auth', 'connect'])
+
+class TransferTest(SSHTestCase):
+    """get_many, put_many and the directory copies."""
+
+    def setUp(self):
+        SSHTestCase.setUp(self)
+        self.range_size = ssh.RANGE_SIZE
+        ssh.RANGE_SIZE = 2 ** 16
+        self.data = os.urandom(2 ** 20 + 123)
+
+    def tearDown(self):
+        ssh.RANGE_SIZE = self.range_size
+        SSHTestCase.tearDown(self)
+
+    def test_ranges_with_few_channels(self):
+        # More sessions are wanted than channels can be opened.
+        connection = self.connect(max_channels = 2)
+        source = self.write('source', self.data)
+        pairs = [(source, self.path('got'))]
+        self.assertEqual(_within(30, connection.get_many, pairs,
+                                 checksum = 'md5'), len(self.data))
+        self.assertEqual(self.read('got'), self.data)
+        pairs = [(source, self.path('put'))]
+        self.assertEqual(_within(30, connection.put_many, pairs,
+                                 checksum = 'sha1'), len(self.data))
+        self.assertEqual(self.read('put'), self.data)
+        self.assertEqual(connection._channels._Semaphore__value, 2)
+
+    def test_small_files(self):
+        connection = self.connect()
+        pairs = [(self.write('small%d' % number, str(number)),
+                  self.path('copy%d' % number)) for number in range(30)]
+        pairs.append((self.write('empty', ''), self.path('empty copy')))
+        connection.get_many(pairs)
+        self.assertEqual([self.read('copy%d' % number)
+                          for number in range(30)],
+                         [str(number) for number in range(30)])
+        self.assertEqual(self.read('empty copy'), '')
+
+    def test_directories(self):
+        connection = self.connect()
+        os.makedirs(self.path('tree/sub'))
+        self.write('tree/sub/file', self.data)
+        self.write('tree/top', 'top')
+        connection.get_directory(self.path('tree'), self.path('down'))
+        connection.put_directory(self.path('down'), self.path('up'))
+        self.assertEqual(self.read('up/sub/file'), self.data)
+        self.assertEqual(self.read('up/top'), 'top')
+
+    def test_errors(self):
+        connection = self.connect()
+        self.assertRaises(IOError, connection.get_many,
+                          [(self.path('missing'), self.path('copy'))])
+        source = self.write('source', 'data')
+        digest = ssh._file_digest
+        ssh._file_digest = lambda filename, algorithm: 'different'
+        try:
+            self.assertRaises(IOError, connection.get_many,
+                              [(source, self.path('copy'))],
+                              checksum = 'md5')
+        finally:
+            ssh._file_digest = digest
+
+class StreamTest(SSHTestCase):
+    """execute_stream()."""
+
+    def test_stderr_flood(self):
+        # Fills stderr long before stdout ends, which would stall a
+        # command whose stdout alone was being read.
+        connection = self.connect()
+        stream = connection.execute_stream(
+            'head -c 4000000 /dev/zero >&2; echo done; exit 3')
+        sizes = {'stdout': 0, 'stderr': 0}
+        for name, data in _within(30, list, stream):
+            sizes[name] += len(data)
+        self.assertEqual(sizes, {'stdout': 5, 'stderr': 4000000})
+        self.assertEqual(stream.exit_status, 3)
+
+
+    def test_line_callback(self):
+        connection = self.connect()
+        lines = []
+        stream = connection.execute_stream(
+            'head -c 100000 /dev/zero | tr "\\0" a; printf "\\nlast"',
+            line_callback = lambda name, line: lines.append(line))
+        self.assertEqual(sum(len(data) for name, data in stream), 100005)
+        self.assertEqual([len(line) for line in lines], [100001, 4])
+
+    def test_stdin(self):
+        connection = self.connect()
+        stream = connection.execute_stream('cat; exit 2',
+                                           stdin = ['a' * 100000, 'b'])
+        self.assertEqual(''.join(data for name, data in stream),
+                         'a' * 100000 + 'b')
+        self.assertEqual(stream.exit_status, 2)
+        stream = connection.execute_stream('cat', stdin = 'one string')
+        self.assertEqual(list(stream), [('stdout', 'one string')])
+
+class SyncTest(SSHTestCase):
+    """Connection.sync()."""
+
+    def setUp(self):
+        SSHTestCase.setUp(self)
+        self.data = os.urandom(2 ** 20)
+
+    def sync(self, local, remote):
+        """Syncs local data over remote data, which may be None for no
+        file, returning the bytes sent."""
+        self.write('local', local)
+        if remote is not None:
+            self.write('remote', remote)
+            os.chmod(self.path('remote'), 0640)
+        sent = self.connect().sync(self.path('local'), self.path('remote'))
+        self.assertEqual(self.read('remote'), local)
+        return sent
+
+    def test_identical(self):
+        self.assertEqual(self.sync(self.data, self.data), 0)
+
+    def test_edited(self):
+        edited = (self.data[:1000] + 'changed' + self.data[1007:500000] +
+                  'inserted' + self.data[500000:])
+        self.assertTrue(self.sync(edited, self.data) < 20000)
+        self.assertEqual(os.stat(self.path('remote')).st_mode & 0777, 0640)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['local', 'remote'])
+
+    def test_moved_blocks(self):
+        # A byte put in near the start moves every block after it.
+        moved = self.data[:1000] + 'x' + self.data[1000:]
+        with_numpy = ssh.numpy
+        try:
+            for numpy in (with_numpy, None):
+                ssh.numpy = numpy
+                self.assertTrue(self.sync(moved, self.data) < 5000)
+        finally:
+            ssh.numpy = with_numpy
+
+    def test_roll(self):
+        data = 'x' + 'abcd' * 4
+        blocks = {zlib.adler32('cdab') & 0xffffffff: {}}
+        self.assertEqual(ssh._sync_roll(data, 0, 13, 4, blocks), 3)
+        self.assertEqual(ssh._sync_roll(data, 3, 13, 4, blocks), 7)
+        self.assertEqual(ssh._sync_roll(data, 0, 13, 4, {}), 14)
+        # The sums roll on as zlib.adler32 would work them out.
+        data = os.urandom(5000)
+        for position in (1, 2, 999, 4000):
+            blocks = {zlib.adler32(data[position:position + 1000]) &
+                      0xffffffff: {}}
+            self.assertEqual(ssh._sync_roll(data, 0, 4000, 1000, blocks),
+                             position)
+
+    def test_new_and_empty(self):
+        self.assertEqual(self.sync(self.data[:5000], None), 5000)
+        self.assertEqual(self.sync('', self.data[:5000]), 0)
+        self.assertEqual(self.sync(self.data[:5000], ''), 5000)
+
+class StartupTest(SSHTestCase):
+    """Lazy connections."""
+
+    def test_lazy(self):
+        connection = self.connect(lazy = True)
+        self.assertEqual(self.server.connections, 0)
+        self.assertTrue(connection.is_alive())
+        self.assertEqual(connection.execute('echo hi'), ['hi\n'])
+        self.assertEqual(self.server.connections, 1)
+        connection.close()
+        self.assertFalse(connection.is_alive())
+        self.assertRaises(paramiko.SSHException, connection.execute, 'true')
+
+
+class ControlMasterTest(SSHTestCase):
+    """ControlMaster, and Connections that use one."""
+
+    def setUp(self):
+        SSHTestCase.setUp(self)
+        self.control_path = self.path('control')
+
+    def serve(self):
+        """Runs a ControlMaster in a thread."""
+        master = ssh.ControlMaster(self.connect(), self.control_path, 1)
+        thread = threading.Thread(target = master.serve)
+        thread.daemon = True
+        thread.start()
+        return master
+
+    def test_commands(self):
+        self.serve()
+        self.assertEqual(os.stat(self.control_path).st_mode & 0777, 0600)
+        connection = self.connect(control_path = self.control_path)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(connection.execute('echo out; echo error >&2'),
+                         ['out\n'])
+        stream = connection.execute_stream('cat; echo e >&2; exit 4',
+                                           stdin = 'x' * 100000)
+        output = list(stream)
+        self.assertEqual(''.join(data for name, data in output
+                                 if name == 'stdout'), 'x' * 100000)
+        self.assertEqual(stream.exit_status, 4)
+        self.assertEqual(len(connection.execute_many(['true'] * 12)), 12)
+        self.assertTrue(connection.is_alive())
+
+    def test_transfers(self):
+        self.serve()
+        connection = self.connect(control_path = self.control_path)
+        data = os.urandom(300000)
+        connection.put(self.write('source', data), self.path('up'))
+        connection.get_many([(self.path('up'), self.path('down'))],
+                            checksum = 'md5')
+        self.assertEqual(self.read('down'), data)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_only_for_its_own_login(self):
+        self.serve()
+        identity = 'tester@127.0.0.1:%d' % self.server.port
+        self.assertTrue(ssh._control_ping(self.control_path, identity))
+        self.assertFalse(ssh._control_ping(self.control_path,
+                                           'bob' + identity[6:]))
+        # Another user, or another server, connects and logs in itself.
+        other = StubServer()
+        self.addCleanup(other.close)
+        self.assertRaises(paramiko.AuthenticationException, self.connect,
+                          username = 'bob', password = 'wrong',
+                          port = other.port,
+                          control_path = self.control_path)
+        connection = self.connect(username = 'bob', port = other.port,
+                                  control_path = self.control_path)
+        self.assertEqual(connection.execute('echo hi'), ['hi\n'])
+        self.assertEqual(other.connections, 2)
+        connection = self.connect(username = 'bob',
+                                  control_path = self.control_path)
+        self.assertEqual(connection.execute('echo hi'), ['hi\n'])
+        self.assertEqual(self.server.connections, 2)
+        self.assertTrue(ssh._control_ping(self.control_path, identity))
+
+    def test_stops_when_idle(self):
+        self.serve()
+        self.connect(control_path = self.control_path).execute('true')
+        time.sleep(2.5)
+        self.assertFalse(os.path.exists(self.control_path))
+        self.assertFalse(ssh._control_ping(self.control_path))
+
+    def test_started_in_background(self):
+        connection = self.connect(control_path = self.control_path,
+                                  control_persist = 1)
+        self.assertEqual(connection.execute('echo hi'), ['hi\n'])
+        self.assertTrue(ssh._control_ping(self.control_path))
+        self.assertEqual(self.server.connections, 1)
+        # It goes once it has been left alone.
+        time.sleep(3)
+        self.assertFalse(ssh._control_ping(self.control_path))
+
+class MetricsTest(SSHTestCase):
+    """Metrics, and the timings Connections give it."""
+
+    def test_metrics(self):
+        metrics = ssh.Metrics(slow_seconds = 0.3)
+        connection = self.connect(metrics = metrics)
+        connection.execute('echo hi')
+        self.server.exec_delay = 0.4
+        connection.execute('true')
+        summary = metrics.summary()
+        self.assertEqual(summary['execute']['count'], 2)
+        self.assertEqual(summary['execute']['bytes'], 3)
+        self.assertEqual(summary['connect']['count'], 1)
+        self.assertTrue('execute' in [slow[2] for slow in metrics.slow])
+        self.assertTrue(metrics.percentile('execute', 100) >= 0.4)
+
+def main():
+    """Run the tests when called directly."""
+    unittest.main()
+
+# start the ball rolling
+if __name__ == "__main__":
+    main()